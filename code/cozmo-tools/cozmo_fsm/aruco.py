@@ -1,6 +1,8 @@
 import cv2, math
 from numpy import sqrt, arctan2, array, multiply
 
+from .events import ArucoEvent
+
 class ArucoMarker(object):
     def __init__(self, aruco_parent, marker_id, bbox, translation, rotation):
         self.id = marker_id
@@ -45,6 +47,7 @@ class ArucoMarker(object):
 
 class Aruco(object):
     def __init__(self, robot, arucolibname, marker_size=50):
+        self.robot = robot
         self.arucolibname = arucolibname
         self.aruco_lib = cv2.aruco.Dictionary_get(arucolibname)
         self.aruco_params = cv2.aruco.DetectorParameters_create()
@@ -86,6 +89,10 @@ class Aruco(object):
                                  self.corners[i], self.tvecs[i][0], self.rvecs[i][0])
             self.seen_marker_ids.append(marker.id)
             self.seen_marker_objects[marker.id] = marker
+        # Only frames with markers are posted, so idle listeners cost nothing.
+        erouter = getattr(self.robot, 'erouter', None)
+        if erouter and self.seen_marker_objects:
+            erouter.post(ArucoEvent(self, self.seen_marker_objects))
 
     def annotate(self, image, scale_factor):
         scaled_corners = [ multiply(corner, scale_factor) for corner in self.corners ]
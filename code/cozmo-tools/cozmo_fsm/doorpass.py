@@ -53,13 +53,8 @@ class GoToWall(StateNode):
 
     def find_closest_wall(self):
         (x,y,theta) = self.robot.world.particle_filter.pose
-        walls = []
-        for obj in self.robot.world.world_map.objects.values():
-            if isinstance(obj,WallObj):
-                distsq = (x-obj.x)**2 + (y-obj.y)**2
-                walls.append((distsq,obj))
-        walls = sorted(walls, key=lambda x: x[0])
-        return 'Wall-%d' % walls[0][1].id if walls else None
+        wall = self.robot.world.world_map.objects.nearest(x, y, WallObj)
+        return wall.id if wall else None
 
     def pick_side(self, dist):
         wall = self.object
@@ -409,8 +404,8 @@ class Explore(StateNode):
     class Think(StateNode):
         def start(self,event=None):
             super().start(event)
-            for key, val in self.robot.world.world_map.objects.items():
-                if isinstance(val,WallObj) and val.id not in self.parent.done_wall and val.id not in self.parent.to_do_wall:
+            for val in self.robot.world.world_map.objects.of_type(WallObj):
+                if val.id not in self.parent.done_wall and val.id not in self.parent.to_do_wall:
                     self.parent.to_do_wall.append(val)
                     print(val.id)
 
@@ -644,26 +639,25 @@ class WallPilotToPose(StateNode):
             mp = (yd-yr)/(xd-xr)
             cp = -xr*mp +yr
 
-            for key, val in self.robot.world.world_map.objects.items():
-                if isinstance(val,WallObj):
-                    x = val.x
-                    y = val.y
-                    m = tan(val.theta + pi/2)
-                    c = -x*m + y
+            for val in self.robot.world.world_map.objects.of_type(WallObj):
+                x = val.x
+                y = val.y
+                m = tan(val.theta + pi/2)
+                c = -x*m + y
 
-                    s1 = m*xr + c - yr
-                    s2 = m*xd + c - yd
-                    if abs(s1)/s1 == abs(s2)/s2:
-                        continue
+                s1 = m*xr + c - yr
+                s2 = m*xd + c - yd
+                if abs(s1)/s1 == abs(s2)/s2:
+                    continue
 
-                    xi = (cp-c)/(m-mp)
-                    yi = m*xi + c
+                xi = (cp-c)/(m-mp)
+                yi = m*xi + c
 
-                    distance = sqrt((x-xi)**2+(y-yi)**2)
+                distance = sqrt((x-xi)**2+(y-yi)**2)
 
-                    if distance < val.length/2 + tolerence:
-                        block_walls.append((sqrt((x-xr)**2+(y-yr)**2),val))
-                        print("Added",val)
+                if distance < val.length/2 + tolerence:
+                    block_walls.append((sqrt((x-xr)**2+(y-yr)**2),val))
+                    print("Added",val)
             if len(block_walls) > 0:
                 self.parent.next_wall = int(sorted(block_walls)[0][1].id)
                 self.post_success()
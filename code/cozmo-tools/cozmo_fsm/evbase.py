@@ -7,6 +7,8 @@
 """
 
 import functools
+import heapq
+from math import ceil
 
 import cozmo
 
@@ -33,10 +35,21 @@ class Event:
 #________________ Event Router ________________
 
 class EventRouter:
-    """An event router drives the state machine."""
-    def __init__(self):
+    """An event router drives the state machine.
+
+    The listener list for each (event_class, source) pair is computed
+    on first post and cached until a listener for that event class is
+    added or removed.  If batch_dispatch is true, all the listeners for
+    an event are run by a single scheduled callback instead of one
+    call_soon per listener."""
+    def __init__(self, batch_dispatch=False):
         # dispatch_table: event_class -> (source,listener)...
         self.dispatch_table = dict()
+        # dispatch_cache: event_class -> source -> tuple of listeners
+        self.dispatch_cache = dict()
+        self.batch_dispatch = batch_dispatch
+        # shared timer for polled listeners
+        self.poll_scheduler = PollScheduler(self)
         # listener_registry: listener -> (event_class, source)...
         self.listener_registry = dict()
         # wildcard registry: true if listener is a wildcard (should run last)
@@ -64,6 +77,7 @@ class EventRouter:
         handlers.append(listener.handle_event)
         source_dict[source] = handlers
         self.dispatch_table[event_class] = source_dict
+        self.dispatch_cache.pop(event_class, None)
         reg_entry = self.listener_registry.get(listener,[])
         reg_entry.append((event_class,source))
         self.listener_registry[listener] = reg_entry
@@ -75,13 +89,17 @@ class EventRouter:
     def add_wildcard_listener(self, listener, event_class, source):
         self.add_listener(listener, event_class, source)
         self.wildcard_registry[listener.handle_event] = True
+        self.dispatch_cache.pop(event_class, None)
 
     def remove_listener(self, listener, event_class, source):
         try:
             del self.wildcard_registry[listener.handle_event]
+            # wildcard status affects listener order for every event class
+            self.dispatch_cache.clear()
         except: pass
         if not issubclass(event_class, Event):
             raise TypeError('% is not an Event' % event_class)
+        self.dispatch_cache.pop(event_class, None)
         source_dict = self.dispatch_table.get(event_class)
         if source_dict is None: return
         handlers = source_dict.get(source)
@@ -112,7 +130,7 @@ class EventRouter:
         source_dict = self.dispatch_table.get(type(event), None)
         if source_dict is None:  # no listeners for this event type
             return []
-        matches = source_dict.get(event.source, [])
+        matches = list(source_dict.get(event.source, []))
         if event.source is None:
             none_matches = matches
             matches = []
@@ -125,19 +143,170 @@ class EventRouter:
             else:
                 matches.append(handler)
         # wildcard handlers must come last in the list
-        return matches + wildcards
+        return tuple(matches + wildcards)
 
     def post(self,event):
         if not isinstance(event,Event):
             raise TypeError('%s is not an Event' % event)
-        listeners = self._get_listeners(event)
-        cnt = 0
-        for listener in listeners:
-            cnt += 1
-            if TRACE.trace_level >= TRACE.listener_invocation:
+        source_cache = self.dispatch_cache.get(type(event), None)
+        if source_cache is None:
+            if type(event) not in self.dispatch_table:
+                return
+            source_cache = dict()
+            self.dispatch_cache[type(event)] = source_cache
+        listeners = source_cache.get(event.source, None)
+        if listeners is None:
+            listeners = self._get_listeners(event)
+            source_cache[event.source] = listeners
+        if TRACE.trace_level >= TRACE.listener_invocation:
+            for listener in listeners:
                 print('TRACE%d:' % TRACE.listener_invocation, listener.__class__, 'receiving', event)
-            self.robot.loop.call_soon(listener,event)
+        if self.batch_dispatch and len(listeners) > 1:
+            self.robot.loop.call_soon(self._deliver, listeners, event)
+        else:
+            for listener in listeners:
+                self.robot.loop.call_soon(listener,event)
+
+    def _deliver(self, listeners, event):
+        """Run a batch of listeners from one scheduled callback.  As with
+        separate callbacks, an exception in one listener is reported to
+        the event loop and does not keep the others from running."""
+        for listener in listeners:
+            try:
+                listener(event)
+            except Exception as exc:
+                self.robot.loop.call_exception_handler(
+                    {'message' : 'Exception in event listener %s' % listener,
+                     'exception' : exc})
     
+#________________ Poll Scheduler ________________
+
+class PollHandle:
+    """Returned by PollScheduler.schedule, and kept by the listener as
+    its poll_handle.  Cancelling it stops the polling."""
+    def __init__(self, scheduler, listener):
+        self.scheduler = scheduler
+        self.listener = listener
+        self.cancelled = False
+        self.due = None      # nominal time of the next poll
+        self.slot = None     # wheel tick of the next poll, if on the wheel
+        self.timer = None    # asyncio handle, if polled off the wheel
+
+    def cancel(self):
+        self.cancelled = True
+        self.slot = None
+        if self.timer:
+            self.timer.cancel()
+            self.timer = None
+
+class PollScheduler:
+    """Runs the poll() methods of all listeners from one timer wheel.
+
+    The wheel turns every tick seconds.  Listeners whose polling
+    interval is a whole number of ticks are filed in the slot of the
+    tick at or after their next poll time, and all the listeners in a
+    slot are polled by a single loop callback.  Slots are kept on a
+    heap, so when nothing is due the loop is not woken at all.  Other
+    intervals get their own call_later chain, as before.
+
+    Lateness of each poll relative to its nominal time is recorded in
+    the stats dictionary."""
+    tick = 0.025
+
+    def __init__(self, erouter):
+        self.erouter = erouter
+        self.epoch = None
+        self.slots = dict()      # tick number -> list of PollHandles
+        self.heap = []           # tick numbers of nonempty slots
+        self.wakeup = None       # (tick number, asyncio handle)
+        self.stats = dict(ticks=0, polls=0, late_polls=0,
+                          total_lateness=0., max_lateness=0.)
+
+    @property
+    def loop(self):
+        return self.erouter.robot.loop
+
+    def on_wheel(self, interval):
+        ticks = interval / self.tick
+        return ticks >= 1 - 1e-6 and abs(ticks - round(ticks)) < 1e-6
+
+    def schedule(self, listener):
+        """Start polling listener every listener.polling_interval seconds."""
+        handle = PollHandle(self, listener)
+        self.file(handle, self.loop.time() + listener.polling_interval)
+        return handle
+
+    def file(self, handle, due):
+        handle.due = due
+        if self.on_wheel(handle.listener.polling_interval):
+            if self.epoch is None:
+                self.epoch = self.loop.time()
+            slot = ceil((due - self.epoch) / self.tick - 1e-6)
+            handle.slot = slot
+            entries = self.slots.get(slot, None)
+            if entries is None:
+                entries = []
+                self.slots[slot] = entries
+                heapq.heappush(self.heap, slot)
+            entries.append(handle)
+            if self.wakeup is None or slot < self.wakeup[0]:
+                self.set_wakeup()
+        else:
+            handle.timer = self.loop.call_at(due, self.run_timer, handle)
+
+    def set_wakeup(self):
+        if self.wakeup:
+            self.wakeup[1].cancel()
+            self.wakeup = None
+        # drop slots whose listeners have all been cancelled
+        while self.heap and not any(handle.slot == self.heap[0]
+                                    for handle in self.slots[self.heap[0]]):
+            del self.slots[heapq.heappop(self.heap)]
+        if self.heap:
+            slot = self.heap[0]
+            self.wakeup = (slot, self.loop.call_at(self.epoch + slot*self.tick, self.run_tick))
+
+    def run_tick(self):
+        self.wakeup = None
+        now = self.loop.time()
+        current = ceil((now - self.epoch) / self.tick - 1e-6)
+        due = []
+        while self.heap and self.heap[0] <= current:
+            slot = heapq.heappop(self.heap)
+            due.extend(handle for handle in self.slots.pop(slot)
+                       if handle.slot == slot and not handle.cancelled)
+        self.stats['ticks'] += 1
+        for handle in due:
+            self.poll(handle, now)
+        self.set_wakeup()
+
+    def run_timer(self, handle):
+        handle.timer = None
+        if not handle.cancelled:
+            self.poll(handle, self.loop.time())
+
+    def poll(self, handle, now):
+        """Poll one listener, rescheduling it first because poll may
+        cancel the handle.  A listener that has fallen behind by more
+        than an interval skips the missed polls rather than bunching
+        them up."""
+        listener = handle.listener
+        lateness = max(0., now - handle.due)
+        stats = self.stats
+        stats['polls'] += 1
+        stats['total_lateness'] += lateness
+        stats['max_lateness'] = max(stats['max_lateness'], lateness)
+        if listener.running and listener.polling_interval:
+            interval = listener.polling_interval
+            due = handle.due + interval
+            if due <= now:
+                stats['late_polls'] += 1
+                due = now + interval
+            self.file(handle, due)
+        else:
+            handle.cancel()
+        listener.poll()
+
 #________________ Event Listener ________________
 
 class EventListener:
@@ -163,8 +332,7 @@ class EventListener:
     def start(self):
         self.running = True
         if self.polling_interval:
-            self.poll_handle = \
-                self.robot.loop.call_later(self.polling_interval, self._next_poll)
+            self.poll_handle = self.robot.erouter.poll_scheduler.schedule(self)
 
     def stop(self):
         if not self.running: return
@@ -181,14 +349,6 @@ class EventListener:
         else:
             raise TypeError('interval must be a number')
 
-    def _next_poll(self):
-        """Called to poll the node and then schedule the next polling interval."""
-        if self.running and self.polling_interval:
-            self.poll_handle = \
-                self.robot.loop.call_later(self.polling_interval, self._next_poll)
-        # schedule the next poll first because self.poll may cancel it
-        self.poll()
-
     def poll(self):
         """Dummy polling function in case sublass neglects to supply one."""
         if TRACE.trace_level >= TRACE.polling:
@@ -62,6 +62,17 @@ class PilotEvent(Event):
         self.status = status
         self.args = args
 
+class ArucoEvent(Event):
+    """ArUco markers seen in a camera image.  Posted once per image
+    that contains at least one marker; source is the Aruco detector."""
+    def __init__(self,source,markers):
+        super().__init__(source)
+        self.markers = markers   # marker id -> ArucoMarker
+        self.marker_ids = list(markers.keys())
+
+    def __repr__(self):
+        return '<%s %s>' % (self.__class__.__name__, self.marker_ids)
+
 #________________ Cozmo-generated events ________________
 
 class CozmoGeneratedEvent(Event):
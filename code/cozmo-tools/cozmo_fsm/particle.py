@@ -3,24 +3,152 @@ Particle filter localization.
 """
 
 import math, array, random
+import threading
+from collections.abc import Mapping
 import numpy as np
 from math import pi, sqrt, sin, cos, atan2, exp
 import cv2
 import cozmo
 
-from .transform import wrap_angle, wrap_selected_angles, tprint
+from .transform import wrap_angle, wrap_angles, wrap_selected_angles, tprint
 from .aruco import ArucoMarker
 from .cozmo_kin import center_of_rotation_offset
 from .worldmap import WorldObject, WallObj, wall_marker_dict, ArucoMarkerObj
 from .perched import Cam
 
+#================ Particle Storage ================
+
+class ParticleStore():
+    """Structure-of-arrays storage for a particle population.  Pose and
+    weight values live in contiguous NumPy arrays so the filter can
+    update all particles at once.  Indexing or iterating over the store
+    yields the Particle objects, whose attributes read and write
+    through to the arrays.
+
+    The version counter advances whenever particle state changes, so
+    the filter can cache statistics computed from it.  Assigning an
+    array attribute (including augmented assignment such as
+    store.log_weight -= err) or writing through a Particle advances it
+    automatically; code that modifies the arrays in place by slicing
+    must call mark_changed().
+
+    take() can change the number of particles.  Other threads, such as
+    the particle viewer, must read through snapshot(), which holds the
+    same lock, rather than iterating over the particles."""
+    array_names = ('x', 'y', 'theta', 'log_weight', 'weight')
+
+    def __init__(self, num_particles=0):
+        self.lock = threading.Lock()
+        self.version = 0
+        self.x = np.zeros(num_particles)
+        self.y = np.zeros(num_particles)
+        self.theta = np.zeros(num_particles)
+        self.log_weight = np.zeros(num_particles)
+        self.weight = np.ones(num_particles)
+        self.members = []
+
+    def __len__(self):
+        return len(self.x)
+
+    def __getitem__(self, index):
+        return self.members[index]
+
+    def __iter__(self):
+        return iter(self.members)
+
+    def __repr__(self):
+        return '<ParticleStore of %d particles>' % len(self)
+
+    def __setattr__(self, name, value):
+        if name in self.array_names:
+            self.__dict__['version'] = self.__dict__.get('version',0) + 1
+        self.__dict__[name] = value
+
+    def mark_changed(self):
+        self.version += 1
+
+    def snapshot(self):
+        "Consistent copies of the (x, y, theta, weight) arrays."
+        with self.lock:
+            return (self.x.copy(), self.y.copy(), self.theta.copy(), self.weight.copy())
+
+    def attach(self, particles):
+        """Bind particle objects to successive slots, copying their state in."""
+        with self.lock:
+            for (i,p) in enumerate(particles):
+                old_store = p.store
+                self.x[i] = old_store.x[p.index]
+                self.y[i] = old_store.y[p.index]
+                self.theta[i] = old_store.theta[p.index]
+                self.log_weight[i] = old_store.log_weight[p.index]
+                self.weight[i] = old_store.weight[p.index]
+                p.store = self
+                p.index = i
+            self.members = list(particles)
+        self.mark_changed()
+
+    def take(self, indices):
+        """Rebuild the population from copies of the particles at
+        indices, which may be longer or shorter than the current one.
+        The new member list is built aside and swapped in with the
+        arrays under the lock, so a list already being iterated is
+        never changed."""
+        num_particles = len(indices)
+        members = self.members[:num_particles]
+        if num_particles > len(members):
+            particle_class = type(members[0])
+            for i in range(len(members), num_particles):
+                # Bypass __init__; its private store would just be discarded.
+                p = particle_class.__new__(particle_class)
+                p.store = self
+                p.index = i
+                members.append(p)
+        (x, y, theta, log_weight, weight) = \
+            (self.x[indices], self.y[indices], self.theta[indices],
+             self.log_weight[indices], self.weight[indices])
+        with self.lock:
+            self.x = x
+            self.y = y
+            self.theta = theta
+            self.log_weight = log_weight
+            self.weight = weight
+            self.members = members
+
+    def set_pose(self, x, y, theta):
+        self.x[:] = x
+        self.y[:] = y
+        self.theta[:] = theta
+        self.reset_weights()
+
+    def reset_weights(self):
+        self.log_weight.fill(0.0)
+        self.weight.fill(1.0)
+        self.mark_changed()
+
+
+def _store_attribute(name):
+    def getter(self):
+        return getattr(self.store,name)[self.index]
+    def setter(self,value):
+        store = self.store
+        getattr(store,name)[self.index] = value
+        store.version += 1
+    return property(getter, setter)
+
 class Particle():
+    store_class = ParticleStore
+
     def __init__(self):
-        self.x = 0
-        self.y = 0
-        self.theta = 0
-        self.log_weight = 0
-        self.weight = 1
+        # A free-standing particle keeps its values in a private store
+        # until a ParticleFilter attaches it to the shared one.
+        self.store = self.store_class(1)
+        self.index = 0
+
+    x = _store_attribute('x')
+    y = _store_attribute('y')
+    theta = _store_attribute('theta')
+    log_weight = _store_attribute('log_weight')
+    weight = _store_attribute('weight')
 
     def __repr__(self):
         return '<Particle (%.2f, %.2f) %.1f deg. log_wt=%f>' % \
@@ -39,14 +167,17 @@ class RandomWithinRadius(ParticleInitializer):
         self.radius = radius
 
     def initialize(self, robot):
-        for p in self.pf.particles:
-            qangle = random.random()*2*pi
-            r = random.gauss(0, self.radius/2) + self.radius/1.5
-            p.x = r * cos(qangle)
-            p.y = r * sin(qangle)
-            p.theta = random.random()*2*pi
-            p.log_weight = 0.0
-            p.weight = 1.0
+        # Spreading the particles out is when an adaptive filter needs
+        # the most of them.
+        self.pf.resize(self.pf.max_particles)
+        particles = self.pf.particles
+        n = len(particles)
+        qangle = np.random.uniform(0, 2*pi, size=n)
+        r = np.random.normal(0, self.radius/2, size=n) + self.radius/1.5
+        particles.x = r * np.cos(qangle)
+        particles.y = r * np.sin(qangle)
+        particles.theta = np.random.uniform(0, 2*pi, size=n)
+        particles.reset_weights()
         self.pf.pose = (0, 0, 0)
         self.pf.motion_model.old_pose = robot.pose
 
@@ -68,12 +199,7 @@ class RobotPosition(ParticleInitializer):
             x = self.x
             y = self.y
             theta = self.theta
-        for p in self.pf.particles:
-            p.x = x
-            p.y = y
-            p.theta = theta
-            p.log_weight = 0.0
-            p.weight = 1.0
+        self.pf.particles.set_pose(x, y, theta)
         self.pf.pose = (x, y, theta)
         self.pf.motion_model.old_pose = robot.pose
     
@@ -85,10 +211,15 @@ class MotionModel():
         self.robot = robot
 
 class DefaultMotionModel(MotionModel):
-    def __init__(self, robot, sigma_trans=0.1, sigma_rot=0.01):
+    """Odometry motion model.  With vectorized=True (the default) the
+    translation and rotation noise for all particles is drawn in a
+    single call and applied to the whole ParticleStore at once; set
+    vectorized=False to use the original per-particle loop."""
+    def __init__(self, robot, sigma_trans=0.1, sigma_rot=0.01, vectorized=True):
         super().__init__(robot)
         self.sigma_trans = sigma_trans
         self.sigma_rot = sigma_rot
+        self.vectorized = vectorized
         self.old_pose = robot.pose
 
     def move(self, particles):
@@ -108,6 +239,8 @@ class DefaultMotionModel(MotionModel):
         new_rx = new_xyz[0] + cor * cos(new_hdg)
         new_ry = new_xyz[1] + cor * sin(new_hdg)
         dist = sqrt((new_rx-old_rx)**2 + (new_ry-old_ry)**2)
+        if dist == 0 and turn_angle == 0:
+            return  # robot didn't move, and noise is proportional to motion
         # Did we drive forward, or was it backward?
         fwd_xy = (old_xyz[0] + dist * cos(old_hdg+turn_angle/2),
                   old_xyz[1] + dist * sin(old_hdg+turn_angle/2))
@@ -120,6 +253,13 @@ class DefaultMotionModel(MotionModel):
         if (fwd_dx*fwd_dx + fwd_dy*fwd_dy) >  (rev_dx*rev_dx + rev_dy*rev_dy):
             dist = - dist    # we drove backward
         rot_var = 0 if abs(turn_angle) < 0.001 else self.sigma_rot
+        if self.vectorized and isinstance(particles, ParticleStore):
+            self.move_store(particles, dist, turn_angle, rot_var)
+        else:
+            self.move_particles(particles, dist, turn_angle, rot_var)
+
+    def move_particles(self, particles, dist, turn_angle, rot_var):
+        cor = center_of_rotation_offset
         for p in particles:
             pdist = dist * (1 + random.gauss(0, self.sigma_trans))
             pturn = random.gauss(turn_angle, rot_var)
@@ -136,6 +276,24 @@ class DefaultMotionModel(MotionModel):
             p.x = p.x - cor * cos(p.theta)
             p.y = p.y - cor * sin(p.theta)
 
+    def move_store(self, particles, dist, turn_angle, rot_var):
+        """Same update as move_particles, applied to the whole store."""
+        cor = center_of_rotation_offset
+        # One draw for both noise terms: row 0 is translation, row 1 rotation.
+        noise = np.random.standard_normal((2, len(particles)))
+        pdist = dist * (1 + self.sigma_trans * noise[0])
+        pturn = turn_angle + rot_var * noise[1]
+        theta = particles.theta
+        # Center of rotation, then half turn, translate, and complete the turn
+        half_theta = theta + pturn/2
+        xc = particles.x + cor * np.cos(theta) + np.cos(half_theta) * pdist
+        yc = particles.y + cor * np.sin(theta) + np.sin(half_theta) * pdist
+        theta = wrap_angles(half_theta + pturn/2)
+        # Move from center of rotation back to (rotated) base frame
+        particles.x = xc - cor * np.cos(theta)
+        particles.y = yc - cor * np.sin(theta)
+        particles.theta = theta
+
 #================ Sensor Model ================
 
 class SensorModel():
@@ -165,6 +323,113 @@ class SensorModel():
             self.last_evaluate_pose = self.robot.pose
         return (dist,turn_angle)
 
+#================ Batched Landmark Likelihood ================
+
+class LandmarkObservations():
+    """Landmark sightings gathered into parallel arrays for the batched
+    likelihood kernel.  Each entry pairs a landmark's map position and
+    orientation with the sensed distance, bearing, and orientation."""
+    def __init__(self):
+        self.lm_x = []
+        self.lm_y = []
+        self.lm_orient = []
+        self.dist = []
+        self.bearing = []
+        self.orient = []
+
+    def __len__(self):
+        return len(self.lm_x)
+
+    def add(self, lm_x, lm_y, dist=0., bearing=0., lm_orient=0., orient=0.):
+        self.lm_x.append(lm_x)
+        self.lm_y.append(lm_y)
+        self.lm_orient.append(lm_orient)
+        self.dist.append(dist)
+        self.bearing.append(bearing)
+        self.orient.append(orient)
+
+def landmark_errors_sq(particles, obs, terms):
+    """Squared sensor errors for every particle (rows) against every
+    observed landmark (columns).  terms is a collection drawn from
+    'distance', 'bearing', 'position', and 'orient'."""
+    px = particles.x[:,np.newaxis]
+    py = particles.y[:,np.newaxis]
+    ptheta = particles.theta[:,np.newaxis]
+    lm_x = np.asarray(obs.lm_x, dtype=float)
+    lm_y = np.asarray(obs.lm_y, dtype=float)
+    dist = np.asarray(obs.dist, dtype=float)
+    bearing = np.asarray(obs.bearing, dtype=float)
+    dx = lm_x - px
+    dy = lm_y - py
+    error_sq = np.zeros(dx.shape)
+    if 'distance' in terms:
+        error_sq += (dist - np.sqrt(dx*dx + dy*dy)) ** 2
+    if 'bearing' in terms:
+        predicted_bearing = wrap_angles(np.arctan2(dy,dx) - ptheta)
+        error_sq += wrap_angles(bearing - predicted_bearing) ** 2
+    if 'position' in terms:
+        # Use sensed bearing and distance to get each particle's
+        # prediction of the landmark position on the world map.
+        direction = ptheta + bearing
+        ex = dx - dist * np.cos(direction)
+        ey = dy - dist * np.sin(direction)
+        error_sq += ex*ex + ey*ey
+    if 'orient' in terms:
+        lm_orient = np.asarray(obs.lm_orient, dtype=float)
+        orient = np.asarray(obs.orient, dtype=float)
+        predicted_orient = wrap_angles(np.arctan2(dy,dx) - lm_orient)
+        error_sq += (dist * wrap_angles(predicted_orient - orient)) ** 2
+    return error_sq
+
+def apply_landmark_likelihood(particles, obs, terms, variance):
+    """Batched likelihood kernel: lower each particle's log_weight by
+    its summed squared error over all observed landmarks."""
+    if len(obs) == 0:
+        return
+    error_sq = landmark_errors_sq(particles, obs, terms)
+    particles.log_weight -= error_sq.sum(axis=1) / variance
+
+def seen_cube_observations(robot, landmarks):
+    """Sensor readings for visible cubes that are landmarks.  Cube poses
+    are in the SDK's coordinate frame, so express them relative to the robot."""
+    obs = LandmarkObservations()
+    for cube in robot.world.light_cubes.values():
+        if not (cube.is_visible and cube in landmarks): continue
+        sensor_dx = cube.pose.position.x - robot.pose.position.x
+        sensor_dy = cube.pose.position.y - robot.pose.position.y
+        sensor_dist = sqrt(sensor_dx*sensor_dx + sensor_dy*sensor_dy)
+        angle = atan2(sensor_dy,sensor_dx)
+        sensor_bearing = wrap_angle(angle - robot.pose.rotation.angle_z.radians)
+        #sensor_orient = wrap_angle(robot.pose.rotation.angle_z.radians -
+        #                           cube.pose.rotation.angle_z.radians +
+        #                           sensor_bearing)
+        # simplifies to...
+        sensor_orient = wrap_angle(angle - cube.pose.rotation.angle_z.radians)
+        landmark_spec = landmarks[cube]
+        # Predicted orientation for a particle:
+        #predicted_bearing = wrap_angle(atan2(lm_y-p.y, lm_x-p.x) - p.theta)
+        #predicted_orient = wrap_angle(p.theta - lm_orient + predicted_bearing)
+        # simplifies to atan2(lm_y-p.y, lm_x-p.x) - lm_orient
+        obs.add(landmark_spec.position.x, landmark_spec.position.y,
+                dist=sensor_dist, bearing=sensor_bearing,
+                lm_orient=landmark_spec.rotation.angle_z.radians,
+                orient=sensor_orient)
+    return obs
+
+def seen_marker_observations(robot, landmarks):
+    """Sensor readings for visible ArUco markers that are landmarks."""
+    obs = LandmarkObservations()
+    # Cache seen_marker_objects because vision is in another thread.
+    seen_marker_objects = robot.world.aruco.seen_marker_objects
+    for (id,marker) in seen_marker_objects.items():
+        if id not in landmarks: continue
+        sensor_coords = marker.camera_coords
+        landmark_spec = landmarks[id]
+        obs.add(landmark_spec.position.x, landmark_spec.position.y,
+                dist=marker.camera_distance,
+                bearing=atan2(sensor_coords[0], sensor_coords[2]))
+    return obs
+
 class ArucoDistanceSensorModel(SensorModel):
     """Sensor model using only landmark distances."""
     def __init__(self, robot, landmarks=None, distance_variance=100):
@@ -182,21 +447,8 @@ class ArucoDistanceSensorModel(SensorModel):
         if (not force) and (dist < 5) and abs(turn_angle) < math.radians(5):
             return False
         self.last_evaluate_pose = self.robot.pose
-        # Cache seen_marker_objects because vision is in another thread.
-        seen_marker_objects = self.robot.world.aruco.seen_marker_objects
-        # Process each seen marker:
-        for id in seen_marker_objects:
-            if id in self.landmarks:
-                sensor_dist = seen_marker_objects[id].camera_distance
-                landmark_spec = self.landmarks[id]
-                lm_x = landmark_spec.position.x
-                lm_y = landmark_spec.position.y
-                for p in particles:
-                    dx = lm_x - p.x
-                    dy = lm_y - p.y
-                    predicted_dist = sqrt(dx*dx + dy*dy)
-                    error = sensor_dist - predicted_dist
-                    p.log_weight -= (error*error)/self.distance_variance
+        obs = seen_marker_observations(self.robot, self.landmarks)
+        apply_landmark_likelihood(particles, obs, ('distance',), self.distance_variance)
         return True
 
 class ArucoBearingSensorModel(SensorModel):
@@ -216,22 +468,8 @@ class ArucoBearingSensorModel(SensorModel):
         if not force and dist < 5 and abs(turn_angle) < math.radians(5):
             return False
         self.last_evaluate_pose = self.robot.pose
-        # Cache seen_marker_objects because vision is in another thread.
-        seen_marker_objects = self.robot.world.aruco.seen_marker_objects
-        # Process each seen marker:
-        for id in seen_marker_objects:
-            if id in self.landmarks:
-                sensor_coords = seen_marker_objects[id].camera_coords
-                sensor_bearing = atan2(sensor_coords[0], sensor_coords[2])
-                landmark_spec = self.landmarks[id]
-                lm_x = landmark_spec.position.x
-                lm_y = landmark_spec.position.y
-                for p in particles:
-                    dx = lm_x - p.x
-                    dy = lm_y - p.y
-                    predicted_bearing = wrap_angle(atan2(dy,dx) - p.theta)
-                    error = wrap_angle(sensor_bearing - predicted_bearing)
-                    p.log_weight -= (error * error) / self.bearing_variance
+        obs = seen_marker_observations(self.robot, self.landmarks)
+        apply_landmark_likelihood(particles, obs, ('bearing',), self.bearing_variance)
         return True
 
 class ArucoCombinedSensorModel(SensorModel):
@@ -251,26 +489,8 @@ class ArucoCombinedSensorModel(SensorModel):
         if not force and dist < 5 and abs(turn_angle) < math.radians(5):
             return False
         self.last_evaluate_pose = self.robot.pose
-        # Cache seen_marker_objects because vision is in another thread.
-        seen_marker_objects = self.robot.world.aruco.seen_marker_objects
-        # Process each seen marker:
-        for id in seen_marker_objects:
-            if id in self.landmarks:
-                sensor_dist = seen_marker_objects[id].camera_distance
-                sensor_coords = seen_marker_objects[id].camera_coords
-                sensor_bearing = atan2(sensor_coords[0], sensor_coords[2])
-                landmark_spec = self.landmarks[id]
-                lm_x = landmark_spec.position.x
-                lm_y = landmark_spec.position.y
-                for p in particles:
-                    # Use sensed bearing and distance to get particle's
-                    # estimate of landmark position on the world map.
-                    predicted_pos_x = p.x + sensor_dist * cos(p.theta + sensor_bearing)
-                    predicted_pos_y = p.y + sensor_dist * sin(p.theta + sensor_bearing)
-                    dx = lm_x - predicted_pos_x
-                    dy = lm_y - predicted_pos_y
-                    error_sq = dx*dx + dy*dy
-                    p.log_weight -= error_sq / self.distance_variance
+        obs = seen_marker_observations(self.robot, self.landmarks)
+        apply_landmark_likelihood(particles, obs, ('position',), self.distance_variance)
         return True
 
 class CubeOrientSensorModel(SensorModel):
@@ -290,41 +510,13 @@ class CubeOrientSensorModel(SensorModel):
         if not force and dist < 5 and abs(turn_angle) < math.radians(5):
             return False
         self.last_evaluate_pose = self.robot.pose
-        seenCubes = [cube for cube in self.robot.world.light_cubes.values()
-                     if cube.is_visible]
-        # Process each seen cube if it's a landmark:
-        for cube in seenCubes:
-            if cube in self.landmarks:
-                sensor_dx = cube.pose.position.x - self.robot.pose.position.x
-                sensor_dy = cube.pose.position.y - self.robot.pose.position.y
-                sensor_dist = sqrt(sensor_dx*sensor_dx + sensor_dy*sensor_dy)
-                angle = atan2(sensor_dy,sensor_dx)
-                sensor_bearing = \
-                    wrap_angle(angle - self.robot.pose.rotation.angle_z.radians)
-                #sensor_orient = wrap_angle(robot.pose.rotation.angle_z.radians -
-                #                           cube.pose.rotation.angle_z.radians +
-                #                           sensor_bearing)
-                # simplifies to...
-                sensor_orient = wrap_angle(angle - cube.pose.rotation.angle_z.radians)
-
-                landmark_spec = self.landmarks[cube]
-                lm_x = landmark_spec.position.x
-                lm_y = landmark_spec.position.y
-                lm_orient = landmark_spec.rotation.angle_z.radians
-
-                for p in particles:
-                    # ... Orientation error:
-                    #predicted_bearing = wrap_angle(atan2(lm_y-p.y, lm_x-p.x) - p.theta)
-                    #predicted_orient = wrap_angle(p.theta - lm_orient + predicted_bearing)
-                    # simplifies to...
-                    predicted_orient = wrap_angle(atan2(lm_y-p.y, lm_x-p.x) - lm_orient)
-                    error_sq = ((predicted_orient - sensor_orient)*sensor_dist)**2
-                    p.log_weight -= error_sq / self.distance_variance
+        obs = seen_cube_observations(self.robot, self.landmarks)
+        apply_landmark_likelihood(particles, obs, ('orient',), self.distance_variance)
         return True
 
 class CubeSensorModel(SensorModel):
     """Sensor model using combined distance, bearing, and orientation information."""
-    def __init__(self, robot, landmarksNone, distance_variance=200):
+    def __init__(self, robot, landmarks=None, distance_variance=200):
         if landmarks is None:
             landmarks = dict()
         super().__init__(robot,landmarks)
@@ -339,47 +531,51 @@ class CubeSensorModel(SensorModel):
         if not force and dist < 5 and abs(turn_angle) < math.radians(5):
             return False
         self.last_evaluate_pose = self.robot.pose
-        seenCubes = [cube for cube in world.light_cubes.values() if cube.is_visible]
-        # Process each seen cube if it's a landmark:
-        for cube in seenCubes:
-            if cube in self.landmarks:
-                sensor_dx = cube.pose.position.x - robot.pose.position.x
-                sensor_dy = cube.pose.position.y - robot.pose.position.y
-                sensor_dist = sqrt(sensor_dx*sensor_dx + sensor_dy*sensor_dy)
-                angle = atan2(sensor_dy,sensor_dx)
-                sensor_bearing = wrap_angle(angle - robot.pose.rotation.angle_z.radians)
-                #sensor_orient = wrap_angle(robot.pose.rotation.angle_z.radians -
-                #                           cube.pose.rotation.angle_z.radians +
-                #                           sensor_bearing)
-                # simplifies to...
-                sensor_orient = wrap_angle(angle - cube.pose.rotation.angle_z.radians)
-
-                landmark_spec = self.landmarks[cube]
-                lm_x = landmark_spec.position.x
-                lm_y = landmark_spec.position.y
-                lm_orient = landmark_spec.rotation.angle_z.radians
-
-                for p in particles:
-                    # ... Bearing and distance errror:
-                    # Use sensed bearing and distance to get particle's
-                    # prediction of landmark position on the world map.
-                    predicted_pos_x = p.x + sensor_dist * cos(p.theta + sensor_bearing)
-                    predicted_pos_y = p.y + sensor_dist * sin(p.theta + sensor_bearing)
-                    dx = lm_x - predicted_pos_x
-                    dy = lm_y - predicted_pos_y
-                    error1_sq = dx*dx + dy*dy
-                    # ... Orientation error:
-                    #predicted_bearing = wrap_angle(atan2(lm_y-p.y, lm_x-p.x) - p.theta)
-                    #predicted_orient = wrap_angle(p.theta - lm_orient + predicted_bearing)
-                    # simplifies to...
-                    predicted_orient = wrap_angle(atan2(lm_y-p.y, lm_x-p.x) - lm_orient)
-                    error2_sq = (sensor_dist*wrap_angle(predicted_orient - sensor_orient))**2
-
-                    error_sq = error1_sq + error2_sq
-                    p.log_weight -= error_sq / self.distance_variance
+        obs = seen_cube_observations(self.robot, self.landmarks)
+        apply_landmark_likelihood(particles, obs, ('position','orient'),
+                                  self.distance_variance)
         return True
 
 
+#================ Resampling Strategies ================
+
+# Each strategy takes an array of (unnormalized) weights and the number
+# of particles to draw, and returns the indices of the chosen parents.
+
+def _normalized_cdf(weights):
+    cdf = np.cumsum(weights)
+    cdf /= cdf[-1]
+    cdf[-1] = 1.0   # guard against roundoff pushing u past the end
+    return cdf
+
+def systematic_resample(weights, n):
+    """Low-variance resampling: one random offset, n evenly spaced pointers."""
+    u = (random.random() + np.arange(n)) / n
+    return np.searchsorted(_normalized_cdf(weights), u)
+
+def stratified_resample(weights, n):
+    """One independent pointer in each of n equal strata."""
+    u = (np.random.random(n) + np.arange(n)) / n
+    return np.searchsorted(_normalized_cdf(weights), u)
+
+def residual_resample(weights, n):
+    """Copy floor(n*w) children of each particle deterministically, then
+    fill the remaining slots by systematic resampling of the residuals."""
+    scaled = n * (weights / weights.sum())
+    counts = np.floor(scaled).astype(int)
+    indices = np.repeat(np.arange(len(weights)), counts)
+    remaining = n - len(indices)
+    if remaining > 0:
+        residuals = scaled - counts
+        indices = np.concatenate((indices, systematic_resample(residuals, remaining)))
+    return indices
+
+resamplers = {
+    'systematic' : systematic_resample,
+    'stratified' : stratified_resample,
+    'residual'   : residual_resample
+    }
+
 #================ Particle Filter ================
 
 class ParticleFilter():
@@ -388,11 +584,36 @@ class ParticleFilter():
                  motion_model = "default",
                  sensor_model = "default",
                  particle_factory = Particle,
-                 landmarks = None):
+                 landmarks = None,
+                 resampler = 'systematic',
+                 ess_threshold = 0.5,
+                 min_particles = None,
+                 max_particles = None,
+                 kld_epsilon = 0.05,
+                 kld_z = 2.33,
+                 kld_bin_xy = 50,
+                 kld_bin_theta = 10*pi/180):
         if landmarks is None:
             landmarks = dict()   # don't do this in the argument list!
         self.robot = robot
-        self.num_particles = num_particles
+        # KLD-sampling adapts the particle count between min_particles
+        # and max_particles on each resample, keeping enough particles
+        # that the sample-based histogram, with bins of kld_bin_xy mm and
+        # kld_bin_theta radians, is within kld_epsilon (K-L divergence) of
+        # the true posterior with confidence given by normal quantile
+        # kld_z.  With the defaults the count stays at num_particles.
+        self.min_particles = num_particles if min_particles is None else min_particles
+        self.max_particles = num_particles if max_particles is None else max_particles
+        self.kld_epsilon = kld_epsilon
+        self.kld_z = kld_z
+        self.kld_bin_xy = kld_bin_xy
+        self.kld_bin_theta = kld_bin_theta
+        if isinstance(resampler, str):
+            resampler = resamplers[resampler]
+        self.resampler = resampler
+        # Resample only when the effective sample size drops below
+        # this fraction of num_particles.  1.0 resamples on every evaluation.
+        self.ess_threshold = ess_threshold
         self.initializer = initializer
         self.initializer.pf = self
         if motion_model == "default":
@@ -404,172 +625,179 @@ class ParticleFilter():
         self.motion_model = motion_model
         self.sensor_model = sensor_model
         self.particle_factory = particle_factory
-        self.particles = [particle_factory() for i in range(num_particles)]
+        store_class = getattr(particle_factory, 'store_class', ParticleStore)
+        self.particles = store_class(num_particles)
+        self.particles.attach([particle_factory() for i in range(num_particles)])
         self.best_particle = self.particles[0]
         self.best_particle_index = 0
         self.min_log_weight = -300  # prevent floating point underflow in exp()
         self.initializer.initialize(robot)
-        self.exp_weights = np.empty(self.num_particles)
         self.dist_jitter = 2 # mm
         self.hdg_jitter = 0.01 # radians
-        self.new_indices = np.empty(self.num_particles, dtype=np.int)
-        self.new_x = np.empty(self.num_particles)
-        self.new_y = np.empty(self.num_particles)
-        self.new_theta = np.empty(self.num_particles)
-        self.cdf = np.empty(self.num_particles)
+        self.new_indices = np.arange(self.num_particles)
         self.pose = (0., 0., 0.)
         self.variance = (np.array([[0,0],[0,0]]), 0.)
+        self.moments_version = None
+
+    @property
+    def num_particles(self):
+        return len(self.particles)
+
+    @property
+    def exp_weights(self):
+        return self.particles.weight
+
+    def resize(self, num_particles):
+        """Grow or shrink the population, cycling through the existing
+        particles to fill new slots."""
+        if num_particles != self.num_particles:
+            self.particles.take(np.arange(num_particles) % self.num_particles)
+            self.new_indices = np.arange(num_particles)
 
     def move(self):
         self.motion_model.move(self.particles)
         if self.sensor_model.evaluate(self.particles):  # true if log_weights changed
             var = self.update_weights()
-            if var > 0:
+            if var > 0 and \
+                   self.effective_sample_size() < self.ess_threshold * self.num_particles:
                 #print('resample')
                 self.resample()
         if self.robot.carrying:
             self.robot.world.world_map.update_carried_object(self.robot.carrying)
 
     def pose_estimate(self):
-        cx = 0.0; cy = 0.0
-        hsin = 0.0; hcos = 0.0
-        weight_sum = 0.0
-        best_particle_index = 0
-        best_particle = self.particles[0]
-        for i in range(len(self.particles)):
-            p = self.particles[i]
-            p.weight = exp(p.log_weight)
-            if p.weight > best_particle.weight:
-                best_particle = p
-                best_particle_index = i
-            cx += p.weight * p.x
-            cy += p.weight * p.y
-            hsin += sin(p.theta) * p.weight
-            hcos += cos(p.theta) * p.weight
-            weight_sum += p.weight
-        if weight_sum == 0:
-            weight_sum = 1
-        cx /= weight_sum
-        cy /= weight_sum
-        self.pose = (cx, cy, atan2(hsin,hcos))
-        self.best_particle = best_particle
-        self.best_particle_index = best_particle_index
+        if self.moments_version != self.particles.version:
+            self.update_moments()
         return self.pose
 
     def variance_estimate(self):
-        weight = var_xx = var_xy = var_yy = r_sin = r_cos = 0
-        (mu_x, mu_y, mu_theta) = self.pose_estimate()
-        for p in self.particles:
-            dx = (p.x - mu_x)
-            dy = (p.y - mu_y)
-            var_xx += dx * dx * p.weight
-            var_xy += dx * dy * p.weight
-            var_yy += dy * dy * p.weight
-            r_sin += sin(p.theta) * p.weight
-            r_cos += cos(p.theta) * p.weight
-            weight += p.weight
+        if self.moments_version != self.particles.version:
+            self.update_moments()
+        return self.variance
+
+    def update_moments(self):
+        """Recompute the weighted mean pose, circular heading mean, and
+        covariance.  pose_estimate() and variance_estimate() return the
+        cached values until the particles or their weights change."""
+        particles = self.particles
+        weights = np.exp(particles.log_weight, out=particles.weight)
+        best_particle_index = int(weights.argmax())
+        weight = weights.sum()
         if weight == 0:
             print('*** weight is zero in variance_estimate() !!!')
             weight = self.num_particles
+            mean_weight = 1
+        else:
+            mean_weight = weight
+        cx = np.dot(weights, particles.x) / mean_weight
+        cy = np.dot(weights, particles.y) / mean_weight
+        r_sin = np.dot(weights, np.sin(particles.theta))
+        r_cos = np.dot(weights, np.cos(particles.theta))
+        dx = particles.x - cx
+        dy = particles.y - cy
+        var_xx = np.dot(weights, dx*dx)
+        var_xy = np.dot(weights, dx*dy)
+        var_yy = np.dot(weights, dy*dy)
         xy_var = np.array([[var_xx, var_xy],
                            [var_xy, var_yy]]) / weight
         Rsq = r_sin**2 + r_cos**2
         Rav = sqrt(Rsq) / weight
         theta_var = max(0, 1 - Rav)
+        self.pose = (cx, cy, atan2(r_sin,r_cos))
         self.variance = (xy_var, theta_var)
-        return self.variance
+        self.best_particle = particles[best_particle_index]
+        self.best_particle_index = best_particle_index
+        self.moments_version = self.particles.version
 
     def update_weights(self):
         # Clip the log_weight values and calculate the new weights.
-        max_weight = max(p.log_weight for p in self.particles)
+        particles = self.particles
+        max_weight = particles.log_weight.max()
         if max_weight >= self.min_log_weight:
             wt_inc = 0.0
         else:
             wt_inc = - self.min_log_weight / 2.0
             print('wt_inc',wt_inc,'applied for max_weight',max_weight)
-        exp_weights = self.exp_weights
-        particles = self.particles
-        for i in range(self.num_particles):
-            p = particles[i]
-            p.log_weight += wt_inc            
-            exp_weights[i] = p.weight = exp(p.log_weight)
-        variance = np.var(exp_weights)
+            particles.log_weight += wt_inc
+        np.exp(particles.log_weight, out=particles.weight)
+        particles.mark_changed()
+        variance = np.var(particles.weight)
         return variance
 
+    def effective_sample_size(self):
+        """Kish's effective sample size of the current weights."""
+        weights = self.particles.weight
+        weight_sum = weights.sum()
+        sum_sq = np.dot(weights, weights)
+        if sum_sq == 0:
+            return 0.
+        return weight_sum * weight_sum / sum_sq
+
     def resample(self):
-        # Compute and normalize the cdf; make local pointers for faster access.
-        exp_weights = self.exp_weights
-        cdf = self.cdf
-        cumsum = 0
-        for i in range(self.num_particles):
-            cumsum += exp_weights[i]
-            cdf[i] = cumsum
-        np.divide(cdf,cumsum,cdf)
-
-        # Resampling loop: choose particles to spawn
-        uincr = 1/self.num_particles
-        u = random.random() * uincr
-        index = 0
-        new_indices = self.new_indices
-        for j in range(self.num_particles):
-            while u > cdf[index]:
-                index += 1
-            new_indices[j] = index
-            u += uincr
-
-        # Now jitter the new particles and copy into the old ones
+        # Choose particles to spawn, then jitter them and copy into the old ones
+        if self.max_particles > self.min_particles:
+            self.new_indices = self.kld_sample(
+                self.resampler(self.exp_weights, self.max_particles))
+        else:
+            self.new_indices = self.resampler(self.exp_weights, self.num_particles)
         self.jitter_new_particles()
         self.install_new_particles()
 
+    def kld_sample(self, indices):
+        """Trim a resample of max_particles draws to the KLD-sampling
+        size: the first n draws (in random order) such that n meets the
+        bound for the number of histogram bins those draws occupy."""
+        indices = indices[np.random.permutation(len(indices))]
+        particles = self.particles
+        bins = np.floor(np.column_stack((
+            particles.x[indices] / self.kld_bin_xy,
+            particles.y[indices] / self.kld_bin_xy,
+            wrap_angles(particles.theta[indices]) / self.kld_bin_theta)))
+        first_draws = np.unique(bins, axis=0, return_index=True)[1]
+        new_bin = np.zeros(len(indices), dtype=bool)
+        new_bin[first_draws] = True
+        k = np.cumsum(new_bin)
+        # Wilson-Hilferty approximation of the chi-square quantile
+        km1 = np.maximum(k - 1, 1)
+        a = 2 / (9 * km1)
+        bound = km1 / (2*self.kld_epsilon) * (1 - a + np.sqrt(a) * self.kld_z)**3
+        bound[k == 1] = 0
+        n = np.arange(1, len(indices)+1)
+        enough = (n >= bound) & (n >= self.min_particles)
+        num_particles = int(enough.argmax()) + 1 if enough.any() else len(indices)
+        return indices[:num_particles]
+
     def jitter_new_particles(self):
-        x_jitter = 0 * np.random.normal(0, self.dist_jitter, size=self.num_particles)
-        y_jitter = 0 * np.random.normal(0, self.dist_jitter, size=self.num_particles)
-        theta_jitter = 0 * np.random.normal(0, self.hdg_jitter, size=self.num_particles)
+        n = len(self.new_indices)
+        x_jitter = 0 * np.random.normal(0, self.dist_jitter, size=n)
+        y_jitter = 0 * np.random.normal(0, self.dist_jitter, size=n)
+        theta_jitter = 0 * np.random.normal(0, self.hdg_jitter, size=n)
 
-        new_x = self.new_x; new_y = self.new_y; new_theta = self.new_theta
         particles = self.particles
-        j = 0
-        for i in self.new_indices:
-            p = particles[i]
-            new_x[j] = p.x + x_jitter[j]
-            new_y[j] = p.y + y_jitter[j]
-            new_theta[j] = wrap_angle(p.theta + theta_jitter[j])
-            j += 1
+        self.new_x = particles.x[self.new_indices] + x_jitter
+        self.new_y = particles.y[self.new_indices] + y_jitter
+        self.new_theta = wrap_angles(particles.theta[self.new_indices] + theta_jitter)
 
     def install_new_particles(self):
         particles = self.particles
-        new_x = self.new_x; new_y = self.new_y; new_theta = self.new_theta
-        for i in range(self.num_particles):
-            p = particles[i]
-            p.x = new_x[i]
-            p.y = new_y[i]
-            p.theta = new_theta[i]
-            p.log_weight = 0.0
-            p.weight = 1.0
+        particles.take(self.new_indices)
+        particles.x = self.new_x
+        particles.y = self.new_y
+        particles.theta = self.new_theta
+        particles.reset_weights()
 
     def increase_variance(self):
         print('Particle filter: increasing variance.')
         particles = self.particles
-        x_jitter = np.random.normal(0, 10*self.dist_jitter, size=self.num_particles)
-        y_jitter = np.random.normal(0, 10*self.dist_jitter, size=self.num_particles)
-        theta_jitter = np.random.normal(0, 20*self.hdg_jitter, size=self.num_particles)
-        for i in range(self.num_particles):
-            p = particles[i]
-            p.x += x_jitter[i]
-            p.y += y_jitter[i]
-            p.theta = wrap_angle(p.theta + theta_jitter[i])
-            p.log_weight = 0.0
-            p.weight = 1.0
+        particles.x += np.random.normal(0, 10*self.dist_jitter, size=self.num_particles)
+        particles.y += np.random.normal(0, 10*self.dist_jitter, size=self.num_particles)
+        particles.theta = wrap_angles(particles.theta +
+                                      np.random.normal(0, 20*self.hdg_jitter, size=self.num_particles))
+        particles.reset_weights()
         self.variance_estimate()
 
     def set_pose(self,x,y,theta):
-        for i in range(self.num_particles):
-            p = self.particles[i]
-            p.x = x
-            p.y = y
-            p.theta = theta
-            p.log_weight = 0.0
-            p.weight = 1.0
+        self.particles.set_pose(x, y, theta)
         self.variance_estimate()
 
     def look_for_new_landmarks(self): pass  # SLAM only
@@ -579,15 +807,194 @@ class ParticleFilter():
 
 #================ Particle SLAM ================
 
-class SLAMParticle(Particle):
-    def __init__(self):
-        super().__init__()
-        self.landmarks = dict()
+class LandmarkTable():
+    """Means and covariances for every landmark with a state vector of
+    a given dimension: 3 for (x, y, orient), 5 for perched cameras
+    (x, y, z, phi, theta).
+
+    The table is copy-on-write.  owner[particle,column] indexes an
+    entry in a pool of (mean, sigma) pairs, and particles descended
+    from the same ancestor share entries.  Entries are never modified
+    once written; writing a landmark allocates fresh entries for the
+    rows being written, so resampling only has to copy the owner
+    indices.  Entries no longer referenced are reclaimed by compact()
+    when the pool fills up."""
+    def __init__(self, num_particles, dim, capacity=8):
+        self.dim = dim
+        self.count = 0
+        self.owner = np.zeros((num_particles, capacity), dtype=int)
+        pool_size = 2 * num_particles * capacity
+        self.pool_count = 0
+        self.pool_mean = np.zeros((pool_size, dim))
+        self.pool_sigma = np.zeros((pool_size, dim, dim))
+
+    def new_column(self):
+        capacity = self.owner.shape[1]
+        if self.count == capacity:
+            owner = np.zeros((self.owner.shape[0], 2*capacity), dtype=int)
+            owner[:, :capacity] = self.owner
+            self.owner = owner
+        column = self.count
+        self.count += 1
+        self.write(slice(None), column, np.zeros(self.dim), np.zeros((self.dim,self.dim)))
+        return column
+
+    def means(self, rows, column):
+        return self.pool_mean[self.owner[rows, column]]
+
+    def sigmas(self, rows, column):
+        return self.pool_sigma[self.owner[rows, column]]
+
+    def write(self, rows, column, mean, sigma):
+        """Store new values for the selected rows of a column.  A single
+        mean vector is stored once and shared by all the rows."""
+        mean = np.asarray(mean)
+        num_entries = 1 if mean.ndim == 1 else len(mean)
+        entries = self.allocate(num_entries)
+        self.pool_mean[entries] = mean
+        self.pool_sigma[entries] = sigma
+        self.owner[rows, column] = entries if num_entries > 1 else entries[0]
+
+    def allocate(self, num_entries):
+        if self.pool_count + num_entries > len(self.pool_mean):
+            self.compact()
+            needed = self.pool_count + num_entries
+            if 2*needed > len(self.pool_mean):
+                pool_size = 2 * needed
+                pool_mean = np.zeros((pool_size, self.dim))
+                pool_sigma = np.zeros((pool_size, self.dim, self.dim))
+                pool_mean[:self.pool_count] = self.pool_mean[:self.pool_count]
+                pool_sigma[:self.pool_count] = self.pool_sigma[:self.pool_count]
+                self.pool_mean = pool_mean
+                self.pool_sigma = pool_sigma
+        start = self.pool_count
+        self.pool_count += num_entries
+        return np.arange(start, self.pool_count)
+
+    def compact(self):
+        """Move the live entries to the front of the pool and renumber them."""
+        owner = self.owner[:, :self.count]
+        live = np.unique(owner)
+        self.pool_mean[:len(live)] = self.pool_mean[live]
+        self.pool_sigma[:len(live)] = self.pool_sigma[live]
+        owner[:] = np.searchsorted(live, owner)
+        self.pool_count = len(live)
+
+    def take(self, indices):
+        self.owner = self.owner[indices]
+
+    def clear(self):
+        self.count = 0
+        self.pool_count = 0
+
+
+class LandmarkStore():
+    """Landmark maps for a whole particle population.  Every particle
+    tracks the same set of landmarks, so a single index maps each
+    landmark id to its table and column.
+
+    Every write to a landmark bumps its version, and resampling bumps
+    the epoch, so clients such as the world map can tell cheaply
+    whether an estimate has changed since they last looked."""
+    def __init__(self, num_particles):
+        self.tables = {3 : LandmarkTable(num_particles, 3),
+                       5 : LandmarkTable(num_particles, 5)}
+        self.columns = dict()
+        self.versions = dict()
+        self.epoch = 0
+
+    def __len__(self):
+        return len(self.columns)
+
+    def __contains__(self, lm_id):
+        return lm_id in self.columns
+
+    def lookup(self, lm_id, dim=3):
+        """Return (table, column) for lm_id, allocating a column if needed."""
+        entry = self.columns.get(lm_id, None)
+        if entry is None or entry[0].dim != dim:
+            table = self.tables[dim]
+            entry = (table, table.new_column())
+            self.columns[lm_id] = entry
+        return entry
+
+    def touch(self, lm_id):
+        self.versions[lm_id] = self.versions.get(lm_id, 0) + 1
+
+    def version(self, lm_id):
+        return (self.epoch, self.versions.get(lm_id, 0))
+
+    def get(self, lm_id, index):
+        (table, column) = self.columns[lm_id]
+        mean = table.means(index, column)
+        mu = mean[0:2].reshape(2,1).copy()
+        if table.dim == 3:
+            orient = float(mean[2])
+        else:
+            orient = mean[2:].copy()
+        return (mu, orient, table.sigmas(index, column).copy())
+
+    def set(self, lm_id, index, value):
+        (mu, orient, sigma) = value
+        orient = np.ravel(orient)
+        (table, column) = self.lookup(lm_id, 2+len(orient))
+        table.write(index, column, np.concatenate((np.ravel(mu), orient)), sigma)
+        self.touch(lm_id)
+
+    def take(self, indices):
+        for table in self.tables.values():
+            table.take(indices)
+        self.epoch += 1
+
+    def clear(self):
+        self.columns.clear()
+        self.versions.clear()
+        self.epoch += 1
+        for table in self.tables.values():
+            table.clear()
+
+
+class LandmarkMap(Mapping):
+    """One particle's view of the LandmarkStore.  Values are
+    (mu, orient, sigma) tuples as in the original per-particle dicts;
+    they are copies, so holding on to one is safe."""
+    def __init__(self, store, index):
+        self.store = store
+        self.index = index
+
+    def __getitem__(self, lm_id):
+        return self.store.get(lm_id, self.index)
+
+    def __setitem__(self, lm_id, value):
+        self.store.set(lm_id, self.index, value)
+
+    def __contains__(self, lm_id):
+        return lm_id in self.store.columns
+
+    def __iter__(self):
+        return iter(tuple(self.store.columns))
+
+    def __len__(self):
+        return len(self.store.columns)
+
+    def version(self, lm_id):
+        return self.store.version(lm_id)
 
     def __repr__(self):
-        return '<SLAMParticle (%.2f, %.2f) %.1f deg. log_wt=%f, %d-lm>' % \
-               (self.x, self.y, self.theta*180/pi, self.log_weight, len(self.landmarks))
+        return '<LandmarkMap of particle %d: %d landmarks>' % (self.index, len(self))
+
+    def clear(self):
+        self.store.clear()
+
+    def copy(self):
+        return dict(self.items())
 
+
+class SLAMParticleStore(ParticleStore):
+    """ParticleStore that also holds the particles' landmark maps, and
+    runs the landmark EKF for a batch of particles at once.  The rows
+    argument of the EKF methods selects particles: a slice or an index
+    array."""
     sigma_r = 50
     sigma_alpha = 15 * (pi/180)
     sigma_phi = 15 * (pi/180)
@@ -605,6 +1012,203 @@ class SLAMParticle(Particle):
                                           [0          , 0             , 0          ,sigma_phi**2, 0],
                                           [0          , 0             , 0          ,0           , sigma_theta**2]])
 
+    def __init__(self, num_particles=0):
+        super().__init__(num_particles)
+        self.landmarks = LandmarkStore(num_particles)
+
+    def attach(self, particles):
+        old_maps = [LandmarkMap(p.store.landmarks, p.index) for p in particles
+                    if isinstance(p.store, SLAMParticleStore)]
+        super().attach(particles)
+        for (i,old_map) in enumerate(old_maps):
+            for (lm_id, value) in old_map.items():
+                self.landmarks.set(lm_id, i, value)
+
+    def landmark_map(self, index):
+        return LandmarkMap(self.landmarks, index)
+
+    @staticmethod
+    def sensor_jacobians_H(dx, dy, dist):
+        """Stacked sensor_jacobian_H for vectors dx, dy."""
+        H = np.zeros((len(dx), 3, 3))
+        q = dist**2
+        H[:,0,0] = dx / dist
+        H[:,0,1] = dy / dist
+        H[:,1,0] = -dy / q
+        H[:,1,1] = dx / q
+        H[:,2,2] = 1
+        return H
+
+    def initial_landmark_sigma(self, dx, dy, dist, Q=None):
+        """Hinv Q Hinv' for stacked H.  H is the (r, alpha) Jacobian, a
+        scaled rotation with a closed-form inverse, followed by an
+        identity block; Q is diagonal, so only the top-left 2x2 block
+        needs transforming."""
+        if Q is None:
+            Q = self.landmark_sensor_variance_Qt
+        Jinv = np.empty((len(dx), 2, 2))
+        Jinv[:,0,0] = dx / dist
+        Jinv[:,0,1] = -dy
+        Jinv[:,1,0] = dy / dist
+        Jinv[:,1,1] = dx
+        sigma = np.repeat(Q[np.newaxis], len(dx), axis=0)
+        sigma[:, :2, :2] = Jinv @ Q[:2, :2] @ Jinv.transpose(0,2,1)
+        return sigma
+
+    def add_landmark(self, lm_id, sensor_dist, sensor_bearing, sensor_orient,
+                     rows=slice(None)):
+        theta = self.theta[rows]
+        direction = theta + sensor_bearing
+        dx = sensor_dist * np.cos(direction)
+        dy = sensor_dist * np.sin(direction)
+        if isinstance(lm_id, cozmo.objects.LightCube):
+            lm_orient = sensor_orient
+        else:  # AruCo marker
+            lm_orient = sensor_orient + theta
+        (table, column) = self.landmarks.lookup(lm_id, 3)
+        lm_mu = np.empty((len(dx), 3))
+        lm_mu[:,0] = self.x[rows] + dx
+        lm_mu[:,1] = self.y[rows] + dy
+        lm_mu[:,2] = lm_orient
+        table.write(rows, column, lm_mu, self.initial_landmark_sigma(dx, dy, sensor_dist))
+        self.landmarks.touch(lm_id)
+
+    def update_landmark(self, lm_id, sensor_dist, sensor_bearing, sensor_orient,
+                        rows=slice(None)):
+        (table, column) = self.landmarks.columns[lm_id]
+        x = self.x[rows]
+        y = self.y[rows]
+        theta = self.theta[rows]
+        old_mu = table.means(rows, column)
+        old_sigma = table.sigmas(rows, column)
+        # (dx,dy) is vector from particle to SENSOR position of lm
+        direction = theta + sensor_bearing
+        dx = sensor_dist * np.cos(direction)
+        dy = sensor_dist * np.sin(direction)
+        H = self.sensor_jacobians_H(dx, dy, sensor_dist)
+        HS = H @ old_sigma
+        Ql = HS @ H.transpose(0,2,1) + self.landmark_sensor_variance_Qt
+        # K = sigma H' Ql^-1, so K' = solve(Ql', H sigma')
+        K = np.linalg.solve(Ql.transpose(0,2,1),
+                            H @ old_sigma.transpose(0,2,1)).transpose(0,2,1)
+        # (ex,ey) is vector from particle to MAP position of lm
+        ex = old_mu[:,0] - x
+        ey = old_mu[:,1] - y
+        delta_sensor = np.empty((len(x), 3))
+        delta_sensor[:,0] = sensor_dist - np.sqrt(ex**2 + ey**2)
+        delta_sensor[:,1] = wrap_angles(sensor_bearing - np.arctan2(ey,ex) + theta)
+        delta_sensor[:,2] = wrap_angles(sensor_orient - old_mu[:,2] + theta)
+        new_mu = old_mu + np.einsum('nij,nj->ni', K, delta_sensor)
+        new_sigma = old_sigma - K @ HS
+        moved = (np.abs(delta_sensor[:,1]) > 0.1) | (np.abs(delta_sensor[:,0]) > 50)
+        if moved.any():
+            # The landmark must have moved, so reset our estimate.
+            new_mu[moved,0] = x[moved] + dx[moved]
+            new_mu[moved,1] = y[moved] + dy[moved]
+            new_mu[moved,2] = sensor_orient
+            new_sigma[moved] = self.initial_landmark_sigma(dx[moved], dy[moved], sensor_dist)
+        table.write(rows, column, new_mu, new_sigma)
+        self.landmarks.touch(lm_id)
+
+    def add_landmark_cam(self, lm_id, sensor_dist, sensor_bearing, sensor_height,
+                         sensor_phi, sensor_theta, rows=slice(None)):
+        theta = self.theta[rows]
+        direction = theta + sensor_bearing
+        dx = sensor_dist * np.cos(direction)
+        dy = sensor_dist * np.sin(direction)
+        (table, column) = self.landmarks.lookup(lm_id, 5)
+        # [x, y, z, orient, pitch]
+        lm_mu = np.empty((len(dx), 5))
+        lm_mu[:,0] = self.x[rows] + dx
+        lm_mu[:,1] = self.y[rows] + dy
+        lm_mu[:,2] = sensor_height
+        lm_mu[:,3] = wrap_angles(sensor_phi + theta)
+        lm_mu[:,4] = sensor_theta
+        table.write(rows, column, lm_mu,
+                    self.initial_landmark_sigma(dx, dy, sensor_dist,
+                                                self.camera_sensor_variance_Qt))
+        self.landmarks.touch(lm_id)
+
+    def update_landmark_cam(self, lm_id, sensor_dist, sensor_bearing, sensor_height,
+                            sensor_phi, sensor_theta, rows=slice(None)):
+        """EKF update of a camera landmark for a batch of particles.
+
+        H is block diagonal, a 2x2 (r, alpha) Jacobian J plus a 3x3
+        identity, and Q is diagonal.  A covariance that starts out as
+        a 2x2 block plus a diagonal keeps that shape through every
+        update, so the gain is computed from a closed-form 2x2 inverse
+        and three scalar ratios instead of a 5x5 inversion."""
+        (table, column) = self.landmarks.columns[lm_id]
+        x = self.x[rows]
+        y = self.y[rows]
+        theta = self.theta[rows]
+        old_mu = table.means(rows, column)
+        old_sigma = table.sigmas(rows, column)
+        A = old_sigma[:, :2, :2]
+        D = np.diagonal(old_sigma[:, 2:, 2:], axis1=1, axis2=2)
+        # (dx,dy) is vector from particle to SENSOR position of lm
+        direction = theta + sensor_bearing
+        dx = sensor_dist * np.cos(direction)
+        dy = sensor_dist * np.sin(direction)
+        q = sensor_dist**2
+        J = np.empty((len(x), 2, 2))
+        J[:,0,0] = dx / sensor_dist
+        J[:,0,1] = dy / sensor_dist
+        J[:,1,0] = -dy / q
+        J[:,1,1] = dx / q
+        Q = self.camera_sensor_variance_Qt
+        JA = J @ A
+        M = JA @ J.transpose(0,2,1) + Q[:2, :2]
+        det = M[:,0,0]*M[:,1,1] - M[:,0,1]*M[:,1,0]
+        Minv = np.empty_like(M)
+        Minv[:,0,0] = M[:,1,1] / det
+        Minv[:,0,1] = -M[:,0,1] / det
+        Minv[:,1,0] = -M[:,1,0] / det
+        Minv[:,1,1] = M[:,0,0] / det
+        K = JA.transpose(0,2,1) @ Minv
+        k = D / (D + np.diagonal(Q)[2:])
+        # (ex,ey) is vector from particle to MAP position of lm
+        ex = old_mu[:,0] - x
+        ey = old_mu[:,1] - y
+        delta_sensor = np.empty((len(x), 5))
+        delta_sensor[:,0] = sensor_dist - np.sqrt(ex**2 + ey**2)
+        delta_sensor[:,1] = wrap_angles(sensor_bearing - np.arctan2(ey,ex) + theta)
+        delta_sensor[:,2] = sensor_height - old_mu[:,2]
+        delta_sensor[:,3] = wrap_angles(sensor_phi + theta - old_mu[:,3])
+        delta_sensor[:,4] = wrap_angles(sensor_theta - old_mu[:,4])
+        new_mu = old_mu.copy()
+        new_mu[:, :2] += np.einsum('nij,nj->ni', K, delta_sensor[:, :2])
+        new_mu[:, 2:] += k * delta_sensor[:, 2:]
+        new_sigma = np.zeros_like(old_sigma)
+        new_sigma[:, :2, :2] = A - K @ JA
+        new_sigma[:, [2,3,4], [2,3,4]] = (1 - k) * D
+        table.write(rows, column, new_mu, new_sigma)
+        self.landmarks.touch(lm_id)
+
+    def take(self, indices):
+        super().take(indices)
+        self.landmarks.take(indices)
+
+
+class SLAMParticle(Particle):
+    store_class = SLAMParticleStore
+
+    @property
+    def landmarks(self):
+        return self.store.landmark_map(self.index)
+
+    def __repr__(self):
+        return '<SLAMParticle (%.2f, %.2f) %.1f deg. log_wt=%f, %d-lm>' % \
+               (self.x, self.y, self.theta*180/pi, self.log_weight, len(self.landmarks))
+
+    sigma_r = SLAMParticleStore.sigma_r
+    sigma_alpha = SLAMParticleStore.sigma_alpha
+    sigma_phi = SLAMParticleStore.sigma_phi
+    sigma_theta = SLAMParticleStore.sigma_theta
+    sigma_z = SLAMParticleStore.sigma_z
+    landmark_sensor_variance_Qt = SLAMParticleStore.landmark_sensor_variance_Qt
+    camera_sensor_variance_Qt = SLAMParticleStore.camera_sensor_variance_Qt
+
     @staticmethod
     def sensor_jacobian_H(dx, dy, dist):
         """Jacobian of sensor values (r, alpha) wrt particle state x,y
@@ -630,95 +1234,77 @@ class SLAMParticle(Particle):
                          [0       , 0       , 0, 0, 1],])
 
     def add_landmark(self, lm_id, sensor_dist, sensor_bearing, sensor_orient):
-        direction = self.theta + sensor_bearing
-        dx = sensor_dist * cos(direction)
-        dy = sensor_dist * sin(direction)
-        lm_x = self.x + dx
-        lm_y = self.y + dy
-
-        if isinstance(lm_id, cozmo.objects.LightCube):
-            lm_orient = sensor_orient
-        else:  # AruCo marker
-            lm_orient = sensor_orient + self.theta
-
-        lm_mu =  np.array([[lm_x], [lm_y]])
-        H = self.sensor_jacobian_H(dx, dy, sensor_dist)
-        Hinv = np.linalg.inv(H)
-        Q = self.landmark_sensor_variance_Qt
-        lm_sigma = Hinv.dot(Q.dot(Hinv.T))
-        self.landmarks[lm_id] = (lm_mu, lm_orient, lm_sigma)
+        self.store.add_landmark(lm_id, sensor_dist, sensor_bearing, sensor_orient,
+                                rows=slice(self.index, self.index+1))
 
     def update_landmark(self, id, sensor_dist, sensor_bearing, sensor_orient,
-                        dx, dy, I=np.eye(3)):
-        # (dx,dy) is vector from particle to SENSOR position of lm
-        (old_mu, old_orient, old_sigma) = self.landmarks[id]
-        H = self.sensor_jacobian_H(dx, dy, sensor_dist)
-        Ql =  H.dot(old_sigma.dot(H.T)) + self.landmark_sensor_variance_Qt
-        Ql_inv = np.linalg.inv(Ql)
-        K = old_sigma.dot((H.T).dot(Ql_inv))
-        z = np.array([[sensor_dist], [sensor_bearing], [sensor_orient]])
-        # (ex,ey) is vector from particle to MAP position of lm
-        ex = old_mu[0,0] - self.x
-        ey = old_mu[1,0] - self.y
-        h = np.array([ [sqrt(ex**2+ey**2)],
-                       [wrap_angle(atan2(ey,ex) - self.theta)],
-                       [wrap_angle(old_orient - self.theta)] ])
-        delta_sensor = wrap_selected_angles(z-h, [1,2])
-        if abs(delta_sensor[1,0]) > 0.1 or abs(delta_sensor[0,0]) > 50:
-            # The landmark must have moved, so reset our estimate.
-            #print('id=%s  dist=%5.1f  brg=%5.1f  orient=%5.1f' %
-            #      (id, sensor_dist, sensor_bearing*180/pi, sensor_orient*180/pi))
-            #print('delta id=', id, delta_sensor)
-            new_mu = np.array([[self.x + sensor_dist*cos(sensor_bearing+self.theta)],
-                               [self.y + sensor_dist*sin(sensor_bearing+self.theta)],
-                               [sensor_orient]])
-            Hinv = np.linalg.inv(H)
-            Q = self.landmark_sensor_variance_Qt
-            new_sigma = Hinv.dot(Q.dot(Hinv.T))
-        else:
-            new_mu = np.append(old_mu,[old_orient]).reshape([3,1]) + K.dot(delta_sensor)
-            new_sigma = (I - K.dot(H)).dot(old_sigma)
-        # [ [x,y], [orient], covariance_matrix]
-        self.landmarks[id] = (new_mu[0:2], new_mu[2], new_sigma)
+                        dx=None, dy=None):
+        # (dx,dy) is recomputed from the particle pose by the store
+        self.store.update_landmark(id, sensor_dist, sensor_bearing, sensor_orient,
+                                   rows=slice(self.index, self.index+1))
 
     def add_landmark_cam(self, lm_id, sensor_dist, sensor_bearing, sensor_height, sensor_phi, sensor_theta):
-        direction = self.theta + sensor_bearing
-        dx = sensor_dist * cos(direction)
-        dy = sensor_dist * sin(direction)
-        lm_x = self.x + dx
-        lm_y = self.y + dy
-
-        lm_height = (sensor_height,wrap_angle(sensor_phi+self.theta), sensor_theta)
-
-        lm_mu =  np.array([[lm_x], [lm_y]])
-        H = self.sensor_jacobian_H_cam(dx, dy, sensor_dist)
-        Hinv = np.linalg.inv(H)
-        Q = self.camera_sensor_variance_Qt
-        lm_sigma = Hinv.dot(Q.dot(Hinv.T))
-        # [ [x,y], [z,orient,pitch], covarience_matrix]
-        self.landmarks[lm_id] = (lm_mu, lm_height, lm_sigma)
+        self.store.add_landmark_cam(lm_id, sensor_dist, sensor_bearing, sensor_height,
+                                    sensor_phi, sensor_theta,
+                                    rows=slice(self.index, self.index+1))
 
     def update_landmark_cam(self, id, sensor_dist, sensor_bearing, sensor_height, sensor_phi, sensor_theta,
-                        dx, dy, I=np.eye(5)):
-        # (dx,dy) is vector from particle to SENSOR position of lm
-        (old_mu, old_height, old_sigma) = self.landmarks[id]
-        H = self.sensor_jacobian_H_cam(dx, dy, sensor_dist)
-        Ql =  H.dot(old_sigma.dot(H.T)) + self.camera_sensor_variance_Qt
-        Ql_inv = np.linalg.inv(Ql)
-        K = old_sigma.dot((H.T).dot(Ql_inv))
-        z = np.array([[sensor_dist], [sensor_bearing], [sensor_height], [wrap_angle(sensor_phi+self.theta)], [sensor_theta]])
-        # (ex,ey) is vector from particle to MAP position of lm
-        ex = old_mu[0,0] - self.x
-        ey = old_mu[1,0] - self.y
-        h = np.array([[sqrt(ex**2+ey**2)],
-                      [wrap_angle(atan2(ey,ex) - self.theta)],
-                      [old_height[0]],
-                      [old_height[1]],
-                      [old_height[2]]])
-        new_mu = np.append(old_mu,[old_height]).reshape([5,1]) + K.dot(wrap_selected_angles(z - h,[1,3,4]))
-        new_sigma = (I - K.dot(H)).dot(old_sigma)
-        # [ [x,y], [z,orient,pitch], covariance_matrix]
-        self.landmarks[id] = (new_mu[0:2], new_mu[2:5], new_sigma)
+                            dx=None, dy=None):
+        # (dx,dy) is recomputed from the particle pose by the store
+        self.store.update_landmark_cam(id, sensor_dist, sensor_bearing, sensor_height,
+                                       sensor_phi, sensor_theta,
+                                       rows=slice(self.index, self.index+1))
+
+
+class WallLikelihoodField():
+    """Precomputed likelihood field for a fixed wall: a grid of squared
+    distances from each cell center to the wall's centerline, covering
+    the wall plus a margin.  Points beyond the margin are clamped to
+    the grid edge, which caps the error for a wildly wrong prediction.
+
+    The wall's marker layout adds an along-wall term: a sighting of a
+    known marker is also scored by how far along the wall it falls
+    from where that marker is mounted, capped at the margin, so that
+    a particle that has slid along the wall is penalized too."""
+    def __init__(self, wall, cell_size=10, margin=250):
+        self.wall_id = wall.id
+        self.cell_size = cell_size
+        self.margin = margin
+        # The wall runs along its local y axis; see generate_wall_obstacles.
+        half_length = wall.length / 2
+        ux = -sin(wall.theta)
+        uy = cos(wall.theta)
+        (x1, y1) = (wall.x - half_length*ux, wall.y - half_length*uy)
+        (x2, y2) = (wall.x + half_length*ux, wall.y + half_length*uy)
+        self.origin = (x1, y1)
+        self.axis = (ux, uy)
+        # Distance of each marker from (x1,y1) along the wall, placed as
+        # in WorldMap.update_walls; it is the same for either face.
+        self.marker_offsets = dict((id, wall.length - value[1][0])
+                                   for (id, value) in wall.markers.items())
+        self.x0 = min(x1,x2) - margin
+        self.y0 = min(y1,y2) - margin
+        nx = int(np.ceil((max(x1,x2) + margin - self.x0) / cell_size))
+        ny = int(np.ceil((max(y1,y2) + margin - self.y0) / cell_size))
+        cx = self.x0 + (np.arange(nx) + 0.5) * cell_size
+        cy = self.y0 + (np.arange(ny) + 0.5) * cell_size
+        (px, py) = np.meshgrid(cx - x1, cy - y1, indexing='ij')
+        # Project each cell center onto the segment and measure the distance.
+        t = np.clip(px*ux + py*uy, 0, 2*half_length)
+        self.grid = (px - t*ux)**2 + (py - t*uy)**2
+
+    def error_sq(self, x, y, marker_id=None):
+        """Squared error of predicted sightings (x,y) of marker_id; if
+        the marker isn't on this wall, only the distance to the wall."""
+        (nx, ny) = self.grid.shape
+        ix = np.clip(((x - self.x0) / self.cell_size).astype(int), 0, nx-1)
+        iy = np.clip(((y - self.y0) / self.cell_size).astype(int), 0, ny-1)
+        error_sq = self.grid[ix, iy]
+        offset = self.marker_offsets.get(marker_id, None)
+        if offset is not None:
+            along = (x - self.origin[0]) * self.axis[0] + (y - self.origin[1]) * self.axis[1] - offset
+            error_sq = error_sq + np.minimum(along*along, self.margin**2)
+        return error_sq
 
 
 class SLAMSensorModel(SensorModel):
@@ -740,8 +1326,12 @@ class SLAMSensorModel(SensorModel):
         self.distance_variance = distance_variance
         self.candidate_landmarks = dict()
         self.use_perched_cameras = False
+        self.wall_fields = dict()
         super().__init__(robot,landmarks)
 
+    def add_wall_field(self, wall):
+        self.wall_fields[wall.id] = WallLikelihoodField(wall)
+
     def rotationMatrixToEulerAngles(self, R) :
         sy = sqrt(R[0,0] * R[0,0] +  R[1,0] * R[1,0])
         singular = sy < 1e-6
@@ -812,10 +1402,44 @@ class SLAMSensorModel(SensorModel):
             wall_markers[wall_id] = markers
             # Now infer the walls from the markers
         for (id,markers) in wall_markers.items():
+            if id in self.wall_fields:
+                continue  # fixed walls are scored by evaluate_wall_fields
             if len(markers) > 1:
                 walls.append(self.infer_wall(id,markers))
         return walls
 
+    def evaluate_wall_fields(self, particles, seen_marker_objects, good_markers, just_looking):
+        """Score the markers seen on fixed walls by looking up each
+        particle's predicted marker position in the wall's likelihood
+        field, which constrains it both across and along the wall.
+        Since the wall's pose is known there is no need to infer it
+        from the markers with solvePnP.  Like the inferred walls, this
+        evidence is ignored while the robot is moving, since the marker
+        sightings are blurred then."""
+        if self.robot.is_moving: return
+        rows = slice(0,1) if just_looking else slice(None)
+        x = particles.x[rows]
+        y = particles.y[rows]
+        theta = particles.theta[rows]
+        error_sq = np.zeros(len(x))
+        scored = False
+        for id in good_markers:
+            wall_spec = wall_marker_dict.get(id, None)
+            if wall_spec is None or wall_spec.id not in self.wall_fields:
+                continue
+            marker = seen_marker_objects[id]
+            sensor_dist = marker.camera_distance
+            sensor_direction = theta + atan2(marker.camera_coords[0],
+                                             marker.camera_coords[2])
+            error_sq += \
+                self.wall_fields[wall_spec.id].error_sq(x + sensor_dist * np.cos(sensor_direction),
+                                                        y + sensor_dist * np.sin(sensor_direction),
+                                                        id)
+            scored = True
+        if scored:
+            particles.log_weight[rows] -= error_sq / self.distance_variance
+            particles.mark_changed()
+
     def evaluate(self, particles, force=False, just_looking=False):
         # Returns true if particles were evaluated.
         # Call with force=True from particle_viewer to skip distance traveled check.
@@ -848,21 +1472,20 @@ class SLAMSensorModel(SensorModel):
         walls = self.generate_walls_from_markers(seen_marker_objects, good_markers)
         for id in walls:
             self.process_landmark(id, just_looking, seen_marker_objects)
+        if self.wall_fields:
+            self.evaluate_wall_fields(particles, seen_marker_objects, good_markers, just_looking)
         if self.use_perched_cameras:
             # add cammeras that can see the robot as landmarks
             perched = list(self.robot.world.perched.camera_pool.get(self.robot.aruco_id,{}).values())
             for id in perched:
                 evaluated = self.process_landmark(id, just_looking, seen_marker_objects) or evaluated
         if evaluated:
-            wmax = - np.inf
-            for p in particles:
-                wmax = max(wmax, p.log_weight)
+            wmax = particles.log_weight.max()
             min_log_weight = self.robot.world.particle_filter.min_log_weight
             if wmax < min_log_weight:
                 wt_inc = min_log_weight - wmax
                 # print('wmax=',wmax,'wt_inc=',wt_inc)
-                for p in particles:
-                    p.log_weight += wt_inc
+                particles.log_weight += wt_inc
             self.robot.world.particle_filter.variance_estimate()
 
         # Update the candidate landmarks and delete any losers
@@ -924,14 +1547,14 @@ class SLAMSensorModel(SensorModel):
                     return False
             print('  *** ADDING LANDMARK %s at:  distance=%6.1f  bearing=%5.1f deg.' %
                   (id, sensor_dist, sensor_bearing*180/pi))
-            for p in particles:
-                if isinstance(id, str) and 'Video' in id:
-                    # special function for cameras as landmark list has more variables
-                    p.add_landmark_cam(id, sensor_dist, sensor_bearing, sensor_height, sensor_phi, sensor_theta)
-                else:
-                    p.add_landmark(id, sensor_dist, sensor_bearing, sensor_orient)
-            # Add new landmark to sensor model's landmark list so worldmap can reference it
-            self.landmarks[id] = self.robot.world.particle_filter.particles[0].landmarks[id]
+            if isinstance(id, str) and 'Video' in id:
+                # special function for cameras as landmark list has more variables
+                particles.add_landmark_cam(id, sensor_dist, sensor_bearing,
+                                           sensor_height, sensor_phi, sensor_theta)
+            else:
+                particles.add_landmark(id, sensor_dist, sensor_bearing, sensor_orient)
+            # The sensor model's landmark list is a view of particle 0's
+            # map, so worldmap can reference the new landmark already.
             # Delete new landmark from tentative candidate list; it's established now.
             if isinstance(id, int):
                 del self.candidate_landmarks[id]
@@ -941,11 +1564,11 @@ class SLAMSensorModel(SensorModel):
             # We can't afford to update all the particles on each
             # camera frame so we'll just update particle 0 and use
             # that to update the sensor model.
-            pp = [particles[0]]
+            rows = slice(0,1)
             evaluated = False
         else:
             # We've moved a bit, so we should update every particle.
-            pp = particles
+            rows = slice(None)
             evaluated = True
 
         if id in self.robot.world.world_map.objects:
@@ -955,32 +1578,30 @@ class SLAMSensorModel(SensorModel):
             should_update_landmark = True
         landmark_is_camera =  isinstance(id, str) and 'Video' in id
 
-        for p in pp:
-            # Use sensed bearing and distance to get
-            # particle's prediction of landmark position in
-            # the world.  Compare to its stored map position.
-            sensor_direction = p.theta + sensor_bearing
-            dx = sensor_dist * cos(sensor_direction)
-            dy = sensor_dist * sin(sensor_direction)
-            predicted_lm_x = p.x + dx
-            predicted_lm_y = p.y + dy
-            (lm_mu, lm_orient, lm_sigma) = p.landmarks[id]
-            map_lm_x = lm_mu[0,0]
-            map_lm_y = lm_mu[1,0]
-            error_x = map_lm_x - predicted_lm_x
-            error_y = map_lm_y - predicted_lm_y
-            error1_sq = error_x**2 + error_y**2
-            error2_sq = 0 # *** (sensor_dist * wrap_angle(sensor_orient - lm_orient))**2
-            p.log_weight -= (error1_sq + error2_sq) / self.distance_variance
-            # Update landmark in this particle's map
-            if should_update_landmark:
-                if landmark_is_camera:
-                    # special function for cameras as landmark list has more variables
-                    p.update_landmark_cam(id, sensor_dist, sensor_bearing,
-                                          sensor_height, sensor_phi, sensor_theta, dx, dy)
-                else:
-                    p.update_landmark(id, sensor_dist, sensor_bearing,
-                                      sensor_orient, dx, dy)
+        # Use sensed bearing and distance to get each particle's
+        # prediction of landmark position in the world.  Compare to
+        # its stored map position.
+        (table, column) = particles.landmarks.columns[id]
+        sensor_direction = particles.theta[rows] + sensor_bearing
+        predicted_lm_x = particles.x[rows] + sensor_dist * np.cos(sensor_direction)
+        predicted_lm_y = particles.y[rows] + sensor_dist * np.sin(sensor_direction)
+        lm_mu = table.means(rows, column)
+        error_x = lm_mu[:,0] - predicted_lm_x
+        error_y = lm_mu[:,1] - predicted_lm_y
+        error1_sq = error_x**2 + error_y**2
+        error2_sq = 0 # *** (sensor_dist * wrap_angle(sensor_orient - lm_orient))**2
+        particles.log_weight[rows] -= (error1_sq + error2_sq) / self.distance_variance
+        particles.mark_changed()
+        # Update landmark in each particle's map
+        if should_update_landmark:
+            if landmark_is_camera:
+                # special function for cameras as landmark list has more variables
+                particles.update_landmark_cam(id, sensor_dist, sensor_bearing,
+                                              sensor_height, sensor_phi, sensor_theta,
+                                              rows=rows)
+            else:
+                particles.update_landmark(id, sensor_dist, sensor_bearing,
+                                          sensor_orient, rows=rows)
         return evaluated
 
 class SLAMParticleFilter(ParticleFilter):
@@ -993,22 +1614,21 @@ class SLAMParticleFilter(ParticleFilter):
             kwargs['initializer'] = RobotPosition(0,0,0)
         super().__init__(robot, **kwargs)
         self.initializer.pf = self
-        self.new_landmarks = [None] * self.num_particles
         if len(self.sensor_model.landmarks) > 0: screwed()
+        self.sensor_model.landmarks = self.particles[0].landmarks
 
     def clear_landmarks(self):
-        for p in self.particles:
-            p.landmarks.clear()
-        self.sensor_model.landmarks.clear()
+        self.particles.landmarks.clear()
 
     def add_fixed_landmark(self,landmark):
         mu = np.array([[landmark.x], [landmark.y]])
         theta = np.array([landmark.theta])
         sigma = np.zeros([3,3])
         mu_theta_sigma = (mu, theta, sigma)
-        for p in self.particles:
-            p.landmarks[landmark.id] = mu_theta_sigma
-        self.sensor_model.landmarks[landmark.id] = mu_theta_sigma
+        # Every particle gets the same entry, so broadcast across all rows.
+        self.particles.landmarks.set(landmark.id, slice(None), mu_theta_sigma)
+        if isinstance(landmark, WallObj):
+            self.sensor_model.add_wall_field(landmark)
 
     def update_weights(self):
         var = super().update_weights()
@@ -1017,21 +1637,6 @@ class SLAMParticleFilter(ParticleFilter):
         self.sensor_model.landmarks = self.particles[0].landmarks
         return var
 
-    def jitter_new_particles(self):
-        super().jitter_new_particles()
-        particles = self.particles  # make local for faster access
-        new_indices = self.new_indices
-        new_landmarks = self.new_landmarks
-        for i in range(self.num_particles):
-            new_landmarks[i] = particles[new_indices[i]].landmarks.copy()
-
-    def install_new_particles(self):
-        super().install_new_particles()
-        particles = self.particles  # make local for faster access
-        new_landmarks = self.new_landmarks
-        for i in range(self.num_particles):
-            particles[i].landmarks = new_landmarks[i]
-
     def look_for_new_landmarks(self):
         """Calls evaluate() to find landmarks and add them to the maps.
         Also updates existing landmarks."""
@@ -263,10 +263,12 @@ class ParticleViewer():
 
 
         # Draw the particles
-        for p in self.robot.world.particle_filter.particles:
-            pscale = 1 - p.weight
+        # The filter may resize the population meanwhile, so draw from a snapshot.
+        (px, py, ptheta, pweight) = self.robot.world.particle_filter.particles.snapshot()
+        for i in range(len(px)):
+            pscale = 1 - pweight[i]
             color=(1,pscale,pscale)
-            self.draw_triangle((p.x,p.y), height=10, angle=math.degrees(p.theta),
+            self.draw_triangle((px[i],py[i]), height=10, angle=math.degrees(ptheta[i]),
                                color=color, fill=True)
 
         # Draw the robot at the best particle location
@@ -297,13 +299,11 @@ class ParticleViewer():
         glutPostRedisplay()
 
     def report_variance(self,pf):
-        weights = np.empty(pf.num_particles)
-        for i in range(pf.num_particles):
-            weights[i] = pf.particles[i].weight
+        weights = pf.particles.snapshot()[3]
         weights.sort()
         var = np.var(weights)
         print('weights:  min = %3.3e  max = %3.3e med = %3.3e  variance = %3.3e' %
-              (weights[0], weights[-1], weights[pf.num_particles//2], var))
+              (weights[0], weights[-1], weights[len(weights)//2], var))
         (xy_var,theta_var) = pf.variance
         print ('xy_var=', xy_var, '  theta_var=', theta_var)
         
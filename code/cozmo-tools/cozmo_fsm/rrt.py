@@ -1,7 +1,11 @@
-from math import pi, sin, cos, inf, asin, atan2, nan, isnan
+from math import pi, sin, cos, inf, asin, atan2, nan, isnan, floor, ceil, sqrt, log
 import numpy as np
 import random
 import time
+import copy
+import multiprocessing
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
 
 import cozmo_fsm.transform
 from .transform import wrap_angle
@@ -40,6 +44,369 @@ class RRTNode():
                    (self.x, self.y, round(self.q/pi*180), self.radius)
 
 
+#---------------- RRTTree ----------------
+
+class RRTTree(list):
+    """A list of RRTNodes that also files each node in a bucketed grid
+    as it is appended, so nearest() only examines the buckets near the
+    target instead of every node in the tree."""
+    def __init__(self, nodes=(), cell_size=50):
+        super().__init__()
+        self.cell_size = cell_size
+        self.buckets = dict()
+        self.cell_bounds = None  # (min_ix, max_ix, min_iy, max_iy)
+        for node in nodes:
+            self.append(node)
+
+    def cell(self, x, y):
+        return (int(x // self.cell_size), int(y // self.cell_size))
+
+    def append(self, node):
+        super().append(node)
+        (ix,iy) = self.cell(node.x, node.y)
+        bucket = self.buckets.get((ix,iy), None)
+        if bucket is None:
+            self.buckets[(ix,iy)] = [node]
+        else:
+            bucket.append(node)
+        if self.cell_bounds is None:
+            self.cell_bounds = (ix, ix, iy, iy)
+        else:
+            (min_ix, max_ix, min_iy, max_iy) = self.cell_bounds
+            self.cell_bounds = (min(min_ix,ix), max(max_ix,ix), min(min_iy,iy), max(max_iy,iy))
+
+    def nearest(self, x, y):
+        """Search rings of cells outward from the target's cell.  A node
+        in ring r+1 or beyond is at least r cells away, so stop once the
+        best distance found is within that radius."""
+        if self.cell_bounds is None:
+            return None
+        (min_ix, max_ix, min_iy, max_iy) = self.cell_bounds
+        (tx,ty) = self.cell(x, y)
+        # Rings that don't reach the occupied region are empty; skip them.
+        r = max(min_ix-tx, tx-max_ix, min_iy-ty, ty-max_iy, 0)
+        r_max = max(tx-min_ix, max_ix-tx, ty-min_iy, max_iy-ty)
+        best_distance = inf
+        closest_node = None
+        buckets = self.buckets
+        while r <= r_max:
+            for ix in range(max(tx-r, min_ix), min(tx+r, max_ix)+1):
+                if ix == tx-r or ix == tx+r:
+                    iy_range = range(max(ty-r, min_iy), min(ty+r, max_iy)+1)
+                else:
+                    iy_range = [iy for iy in (ty-r, ty+r) if min_iy <= iy <= max_iy]
+                for iy in iy_range:
+                    bucket = buckets.get((ix,iy), None)
+                    if bucket is None: continue
+                    for this_node in bucket:
+                        distx = this_node.x - x
+                        disty = this_node.y - y
+                        distsq = distx*distx + disty*disty
+                        if distsq < best_distance:
+                            best_distance = distsq
+                            closest_node = this_node
+            reach = r * self.cell_size
+            if best_distance <= reach*reach:
+                break
+            r += 1
+        return closest_node
+
+    def near(self, x, y, radius):
+        "All nodes within radius of (x,y)."
+        if self.cell_bounds is None:
+            return []
+        (min_ix, max_ix, min_iy, max_iy) = self.cell_bounds
+        (ix0, iy0) = self.cell(x-radius, y-radius)
+        (ix1, iy1) = self.cell(x+radius, y+radius)
+        radiussq = radius * radius
+        result = []
+        buckets = self.buckets
+        for ix in range(max(ix0, min_ix), min(ix1, max_ix)+1):
+            for iy in range(max(iy0, min_iy), min(iy1, max_iy)+1):
+                bucket = buckets.get((ix,iy), None)
+                if bucket is None: continue
+                for node in bucket:
+                    distx = node.x - x
+                    disty = node.y - y
+                    if distx*distx + disty*disty <= radiussq:
+                        result.append(node)
+        return result
+
+
+#---------------- C-Space Occupancy Grid ----------------
+
+class CSpaceGrid():
+    """Occupancy bitmap over (heading bin, x, y) for the robot's
+    footprint, rasterized from the obstacle list.  Obstacles are grown
+    by half a cell diagonal, so a free cell guarantees that the robot
+    collides with nothing anywhere in that cell; an occupied cell only
+    means an exact test is needed.  counts holds the number of
+    obstacles covering each cell, so an obstacle that moves can be
+    subtracted and re-added without rebuilding the others."""
+    def __init__(self, rrt, bounds, cell_size=10):
+        self.rrt = rrt
+        self.bounds = bounds
+        self.cell_size = cell_size
+        (xmin, xmax, ymin, ymax) = bounds
+        self.x0 = xmin
+        self.y0 = ymin
+        self.nx = int(np.ceil((xmax-xmin) / cell_size))
+        self.ny = int(np.ceil((ymax-ymin) / cell_size))
+        self.num_bins = int(round(2*pi / rrt.q_tol))
+        self.counts = np.zeros((self.num_bins, self.nx, self.ny), dtype=np.uint16)
+        self.inflation = cell_size * sqrt(2) / 2
+        self.shapes = dict()   # signature -> obstacle
+        parts = rrt.footprint(RRTNode(x=0, y=0, q=0))
+        self.robot_reach = max(sqrt(part.center[0,0]**2 + part.center[1,0]**2) +
+                               part.bounding_radius for part in parts)
+
+    @staticmethod
+    def usable(rrt):
+        "The heading bins must tile the circle exactly."
+        bins = 2*pi / rrt.q_tol
+        return abs(bins - round(bins)) < 1e-6
+
+    @staticmethod
+    def signature(shape):
+        if isinstance(shape, Rectangle):
+            return ('rect', round(shape.center[0,0],3), round(shape.center[1,0],3),
+                    round(shape.orient,6), round(shape.max_Ex-shape.min_Ex,3),
+                    round(shape.max_Ey-shape.min_Ey,3))
+        elif isinstance(shape, Circle):
+            return ('circle', round(shape.center[0,0],3), round(shape.center[1,0],3),
+                    round(shape.radius,3))
+        elif isinstance(shape, Compound):
+            return ('compound',) + tuple(CSpaceGrid.signature(s) for s in shape.shapes)
+        else:
+            return ('other', id(shape))
+
+    def update(self, obstacles):
+        """Rasterize obstacles that are new or have moved, and remove
+        those that are gone."""
+        new_shapes = dict((self.signature(obst), obst) for obst in obstacles)
+        for (sig, obst) in tuple(self.shapes.items()):
+            if sig not in new_shapes:
+                self.rasterize(obst, -1)
+                del self.shapes[sig]
+        for (sig, obst) in new_shapes.items():
+            if sig not in self.shapes:
+                self.rasterize(obst, +1)
+                self.shapes[sig] = obst
+
+    def rasterize(self, obstacle, increment):
+        grown = obstacle.inflated(self.inflation)
+        (xmin, xmax, ymin, ymax) = grown.extent()
+        reach = self.robot_reach
+        ix0 = max(0, int((xmin - reach - self.x0) // self.cell_size))
+        ix1 = min(self.nx, int((xmax + reach - self.x0) // self.cell_size) + 1)
+        iy0 = max(0, int((ymin - reach - self.y0) // self.cell_size))
+        iy1 = min(self.ny, int((ymax + reach - self.y0) // self.cell_size) + 1)
+        if ix0 >= ix1 or iy0 >= iy1:
+            return
+        cx = self.x0 + (np.arange(ix0, ix1) + 0.5) * self.cell_size
+        cy = self.y0 + (np.arange(iy0, iy1) + 0.5) * self.cell_size
+        (dx, dy) = np.meshgrid(cx, cy, indexing='ij')
+        for b in range(self.num_bins):
+            hits = np.zeros(dx.shape, dtype=bool)
+            for part in self.rrt.footprint(RRTNode(x=0, y=0, q=b*self.rrt.q_tol)):
+                hits |= collides_translated(part, grown, dx, dy)
+            window = self.counts[b, ix0:ix1, iy0:iy1]
+            if increment > 0:
+                window += hits
+            else:
+                window -= hits
+
+    def free_mask(self, x, y, keys):
+        "Vectorized is_free for poses (x[k], y[k]) in heading bins keys[k]."
+        ix = np.floor((x - self.x0) / self.cell_size).astype(int)
+        iy = np.floor((y - self.y0) / self.cell_size).astype(int)
+        inside = (ix >= 0) & (ix < self.nx) & (iy >= 0) & (iy < self.ny)
+        free = np.zeros(len(x), dtype=bool)
+        b = np.asarray(keys)[inside] % self.num_bins
+        free[inside] = self.counts[b, ix[inside], iy[inside]] == 0
+        return free
+
+    def is_free(self, node):
+        """True if the footprint at node is certainly collision-free;
+        False if the grid can't tell."""
+        if isnan(node.q):
+            return False
+        ix = int((node.x - self.x0) // self.cell_size)
+        iy = int((node.y - self.y0) // self.cell_size)
+        if ix < 0 or ix >= self.nx or iy < 0 or iy >= self.ny:
+            return False
+        b = round(node.q / self.rrt.q_tol) % self.num_bins
+        return self.counts[b, ix, iy] == 0
+
+
+#---------------- Samplers ----------------
+
+class Sampler():
+    """Chooses the random points that the RRT grows its trees toward.
+    setup() is called at the start of each search, once the planner's
+    bounds have been set.  sample() may be passed the root of the tree
+    that is not being extended, for samplers that aim at it.  The
+    base class samples uniformly over the planner's bounds."""
+    def __init__(self):
+        self.rrt = None
+
+    def __getstate__(self):
+        # Samplers travel with planner snapshots; the planner doesn't.
+        state = self.__dict__.copy()
+        state['rrt'] = None
+        return state
+
+    def setup(self, rrt, start, goal):
+        self.rrt = rrt
+
+    def sample(self, target=None):
+        rng = self.rrt.rng
+        return RRTNode(x=rng.choice(self.rrt.bounds[0]),
+                       y=rng.choice(self.rrt.bounds[1]))
+
+class UniformSampler(Sampler):
+    "Uniform over the planner's bounds; the planner's default."
+
+class GoalBiasedSampler(Sampler):
+    "With probability bias, aim straight at the other tree's root."
+    def __init__(self, bias=0.1, base=None):
+        super().__init__()
+        self.bias = bias
+        self.base = base or UniformSampler()
+
+    def setup(self, rrt, start, goal):
+        super().setup(rrt, start, goal)
+        self.base.setup(rrt, start, goal)
+
+    def sample(self, target=None):
+        if target is not None and self.rrt.rng.random() < self.bias:
+            return RRTNode(x=target.x, y=target.y)
+        return self.base.sample(target)
+
+class ObstacleSampler(Sampler):
+    """Base for samplers that look at where the obstacles are.  A point
+    counts as blocked if a disk of radius clearance around it touches
+    an obstacle; the default clearance is half the robot's width.
+    setup() rasterizes this into a grid of cell_size cells, so each
+    test afterwards is just a lookup."""
+    def __init__(self, clearance=None, cell_size=10, base=None):
+        super().__init__()
+        self.clearance = clearance
+        self.cell_size = cell_size
+        self.base = base or UniformSampler()
+
+    def setup(self, rrt, start, goal):
+        super().setup(rrt, start, goal)
+        self.base.setup(rrt, start, goal)
+        if self.clearance is None:
+            extents = np.array([part.extent() for part in rrt.footprint(RRTNode(q=0))])
+            width = min(extents[:,1].max() - extents[:,0].min(),
+                        extents[:,3].max() - extents[:,2].min())
+            self.radius = width / 2
+        else:
+            self.radius = self.clearance
+        probe = Circle(transform.point(0,0), self.radius)
+        (xrange, yrange) = rrt.bounds
+        self.x0 = xrange.start
+        self.y0 = yrange.start
+        nx = max(1, len(xrange) // self.cell_size)
+        ny = max(1, len(yrange) // self.cell_size)
+        cx = self.x0 + (np.arange(nx) + 0.5) * self.cell_size
+        cy = self.y0 + (np.arange(ny) + 0.5) * self.cell_size
+        (gx, gy) = np.meshgrid(cx, cy, indexing='ij')
+        self.occupied = np.zeros(gx.shape, dtype=bool)
+        for obstacle in rrt.obstacles:
+            self.occupied |= collides_translated(probe, obstacle, gx, gy)
+
+    def blocked(self, x, y):
+        "Points outside the bounds count as blocked."
+        ix = np.floor((np.asarray(x) - self.x0) / self.cell_size).astype(int)
+        iy = np.floor((np.asarray(y) - self.y0) / self.cell_size).astype(int)
+        (nx, ny) = self.occupied.shape
+        inside = (ix >= 0) & (ix < nx) & (iy >= 0) & (iy < ny)
+        result = np.ones(ix.shape, dtype=bool)
+        result[inside] = self.occupied[ix[inside], iy[inside]]
+        return result
+
+class GaussianSampler(ObstacleSampler):
+    """Gaussian sampling: draw a pair of points sigma apart and keep
+    the free one if exactly one is blocked, which concentrates samples
+    along obstacle boundaries."""
+    def __init__(self, sigma=50, attempts=10, clearance=None, base=None):
+        super().__init__(clearance, base=base)
+        self.sigma = sigma
+        self.attempts = attempts
+
+    def sample(self, target=None):
+        for _ in range(self.attempts):
+            p = self.base.sample(target)
+            x = p.x + self.rrt.rng.gauss(0, self.sigma)
+            y = p.y + self.rrt.rng.gauss(0, self.sigma)
+            (blocked_p, blocked_q) = self.blocked([p.x, x], [p.y, y])
+            if blocked_p and not blocked_q:
+                return RRTNode(x=x, y=y)
+            elif blocked_q and not blocked_p:
+                return p
+        return self.base.sample(target)
+
+class BridgeSampler(ObstacleSampler):
+    """Bridge test: draw two blocked points about sigma apart and keep
+    their midpoint if it is free.  Such midpoints lie in narrow gaps
+    like doorways, which uniform sampling rarely hits."""
+    def __init__(self, sigma=150, attempts=10, clearance=None, base=None):
+        super().__init__(clearance, base=base)
+        self.sigma = sigma
+        self.attempts = attempts
+
+    def sample(self, target=None):
+        for _ in range(self.attempts):
+            p = self.base.sample(target)
+            x = p.x + self.rrt.rng.gauss(0, self.sigma)
+            y = p.y + self.rrt.rng.gauss(0, self.sigma)
+            mx = (p.x + x) / 2
+            my = (p.y + y) / 2
+            (blocked_p, blocked_q, blocked_m) = self.blocked([p.x, x, mx], [p.y, y, my])
+            if blocked_p and blocked_q and not blocked_m:
+                return RRTNode(x=mx, y=my)
+        return self.base.sample(target)
+
+class FreeSpaceSampler(ObstacleSampler):
+    """Sample only from free space that is connected to the start or
+    the goal, by flood filling the free cells of the occupancy grid
+    from the cells around the start and goal."""
+    def __init__(self, cell_size=25, clearance=None, base=None):
+        super().__init__(clearance, cell_size, base)
+
+    def setup(self, rrt, start, goal):
+        super().setup(rrt, start, goal)
+        free = ~self.occupied
+        reached = np.zeros(free.shape, dtype=bool)
+        for node in (start, goal):
+            ix = int((node.x - self.x0) // self.cell_size)
+            iy = int((node.y - self.y0) // self.cell_size)
+            reached[max(ix-2,0):ix+3, max(iy-2,0):iy+3] = True
+        reached &= free
+        while True:
+            grown = reached.copy()
+            grown[1:,:] |= reached[:-1,:]
+            grown[:-1,:] |= reached[1:,:]
+            grown[:,1:] |= reached[:,:-1]
+            grown[:,:-1] |= reached[:,1:]
+            grown &= free
+            if (grown == reached).all():
+                break
+            reached = grown
+        self.cells = np.argwhere(reached)
+
+    def sample(self, target=None):
+        if len(self.cells) == 0:
+            return self.base.sample(target)
+        rng = self.rrt.rng
+        (ix, iy) = self.cells[rng.randrange(len(self.cells))]
+        return RRTNode(x=self.x0 + (ix + rng.random()) * self.cell_size,
+                       y=self.y0 + (iy + rng.random()) * self.cell_size)
+
+
 #---------------- RRT Path Planner ----------------
 
 class RRTException(Exception):
@@ -54,21 +421,62 @@ class RRT():
     def __init__(self, robot, max_iter=2000, step_size=10, arc_radius=40,
                  xy_tolsq=90, q_tol=5*pi/180,
                  obstacles=[], auto_obstacles=True,
-                 bounds=(range(-500,500), range(-500,500))):
+                 bounds=(range(-500,500), range(-500,500)),
+                 use_cspace_grid=False, grid_cell_size=10,
+                 anytime=False, time_budget=1.0, informed=True,
+                 use_plan_cache=False, reuse_goal_tree=False,
+                 parallel=0, parallel_deadline=None, sampler=None, seed=None):
         self.robot = robot
+        self.rng = random.Random(seed)
         self.max_iter = max_iter
         self.step_size = step_size
         self.arc_radius = arc_radius
         self.xy_tolsq = xy_tolsq
         self.q_tol = q_tol
-        self.robot_parts = self.make_robot_parts(robot)
+        if robot is not None:
+            self.robot_parts = self.make_robot_parts(robot)
+        else:
+            self.robot_parts = []   # filled in by from_snapshot
+        self.footprints = dict()
+        self.min_batch = 4
+        # Work counters for the last plan_path call
+        self.collision_checks = 0
+        self.stats = dict()
         self.bounds = bounds
         self.obstacles = obstacles
+        self.obstacle_tree = None
         self.auto_obstacles = auto_obstacles
         self.treeA = []
         self.treeB = []
         self.start = None
         self.goal = None
+        # Optional C-space occupancy grid, refreshed on each plan_path
+        self.use_cspace_grid = use_cspace_grid
+        self.grid_cell_size = grid_cell_size
+        self.cspace = None
+        # Anytime RRT* mode; only used when the robot may turn in place
+        self.anytime = anytime
+        self.time_budget = time_budget
+        self.informed = informed
+        self.star_step = 100
+        self.goal_bias = 0.05
+        self.solution_history = []
+        self.sampler = sampler or UniformSampler()
+        # Plans for recently seen problems, and the goal tree from the
+        # last query if it is to be grown further on the next one
+        self.use_plan_cache = use_plan_cache
+        self.plan_cache = OrderedDict()
+        self.plan_cache_size = 32
+        self.cache_cell = 10
+        self.reuse_goal_tree = reuse_goal_tree
+        self.goal_tree = None
+        self.goal_tree_key = None
+        # Multi-start planning on a process pool, started on first use
+        self.parallel = parallel
+        self.parallel_deadline = parallel_deadline
+        self.executor = None
+        self.generation = None
+        self.should_stop = None
 
     REACHED = 'reached'
     COLLISION = 'collision' 
@@ -76,8 +484,31 @@ class RRT():
 
     def set_obstacles(self,obstacles):
         self.obstacles = obstacles
+        self.obstacle_tree = AABBTree(obstacles)
+        if self.use_cspace_grid:
+            self.update_cspace()
+
+    def update_cspace(self):
+        """Bring the C-space grid up to date with self.obstacles.  Only
+        obstacles that changed are re-rasterized, unless the obstacles
+        have spread beyond the grid and it must be reallocated."""
+        if not self.obstacles or not CSpaceGrid.usable(self):
+            self.cspace = None
+            return
+        extents = np.array([obst.extent() for obst in self.obstacles])
+        quantum = 500
+        bounds = (floor(extents[:,0].min() / quantum) * quantum - quantum,
+                  ceil(extents[:,1].max() / quantum) * quantum + quantum,
+                  floor(extents[:,2].min() / quantum) * quantum - quantum,
+                  ceil(extents[:,3].max() / quantum) * quantum + quantum)
+        if self.cspace is None or self.cspace.bounds != bounds or \
+               self.cspace.cell_size != self.grid_cell_size:
+            self.cspace = CSpaceGrid(self, bounds, self.grid_cell_size)
+        self.cspace.update(self.obstacles)
 
     def nearest_node(self, tree, target_node):
+        if isinstance(tree, RRTTree):
+            return tree.nearest(target_node.x, target_node.y)
         best_distance = inf
         closest_node = None
         x = target_node.x
@@ -91,9 +522,8 @@ class RRT():
                 closest_node = this_node
         return closest_node
 
-    def random_node(self):
-        return RRTNode(x=random.choice(self.bounds[0]),
-                       y=random.choice(self.bounds[1]))
+    def random_node(self, target=None):
+        return self.sampler.sample(target)
 
     def extend(self, tree, target):
         nearest = self.nearest_node(tree, target)
@@ -141,45 +571,221 @@ class RRT():
             parts.append(this_part)
         return parts
 
+    def footprint(self, node):
+        """Robot parts at node, with the heading quantized to q_tol.
+        The parts for each heading bin are built once, at the origin,
+        and afterwards only need to be translated.  They are grown to
+        cover every heading in the bin, so a template that misses an
+        obstacle guarantees the exact footprint does too."""
+        if isnan(node.q):
+            return self.robot_parts_to_node(node)
+        template = self.footprint_template(round(node.q / self.q_tol))
+        return [part.translated(node.x, node.y) for part in template]
+
+    def footprint_template(self, key):
+        template = self.footprints.get(key, None)
+        if template is None:
+            # A heading within q_tol/2 of the bin's moves a point at
+            # distance r from the origin by at most r * q_tol/2.
+            template = []
+            for part in self.robot_parts_to_node(RRTNode(q=key*self.q_tol)):
+                reach = sqrt(part.center[0,0]**2 + part.center[1,0]**2) + part.bounding_radius
+                template.append(part.inflated(reach * self.q_tol / 2))
+            self.footprints[key] = template
+        return template
+
+    def broad_phase(self):
+        tree = self.obstacle_tree
+        if tree is None or tree.shapes is not self.obstacles:
+            # obstacles was assigned directly; rebuild the broad phase
+            tree = self.obstacle_tree = AABBTree(self.obstacles)
+        return tree
+
     def collides(self, node):
-        for part in self.robot_parts_to_node(node):
-            for obstacle in self.obstacles:
+        """Returns the obstacle the robot hits at node, or False.  The
+        grown footprint template is tried first; only if it hits
+        something is the exact footprint at node's heading tested."""
+        self.collision_checks += 1
+        if self.use_cspace_grid and self.cspace is not None and self.cspace.is_free(node):
+            return False
+        if isnan(node.q) or self.parts_collide(self.footprint(node)):
+            return self.parts_collide(self.robot_parts_to_node(node))
+        return False
+
+    def template_free(self, x, y, key):
+        "True if the grown template for heading bin key is clear at (x,y)."
+        template = self.footprint_template(key)
+        return not self.parts_collide([part.translated(x, y) for part in template])
+
+    def parts_collide(self, parts):
+        obstacles = self.obstacles
+        tree = self.broad_phase()
+        for part in parts:
+            px = part.center[0,0]
+            py = part.center[1,0]
+            pr = part.bounding_radius
+            for index in tree.query(px-pr, px+pr, py-pr, py+pr):
+                obstacle = obstacles[index]
+                # Cheap bounding-circle test before the full shape test.
+                # Shapes lie inside their bounding circles and the circle
+                # tests are exact, so this only saves time.
+                bounding_radius = getattr(obstacle, 'bounding_radius', None)
+                if bounding_radius is not None:
+                    dx = obstacle.center[0,0] - px
+                    dy = obstacle.center[1,0] - py
+                    reach = bounding_radius + pr
+                    if dx*dx + dy*dy >= reach*reach:
+                        continue
                 if part.collides(obstacle):
                     return obstacle
-        return False        
+        return False
+
+    def collides_batch(self, x, y, q):
+        """Check the poses (x[k], y[k], q[k]) along a segment in one go.
+        Returns the index of the first pose that collides, or None.
+        Poses are grouped by heading bin so each group shares one
+        footprint template and can be tested with a single vectorized
+        separating-axis computation; a pose where the grown template
+        hits something is then checked exactly, as in collides().  Bins
+        holding only a few poses, as when turning in place, are cheaper
+        to test one at a time."""
+        x = np.asarray(x, dtype=float)
+        y = np.asarray(y, dtype=float)
+        q = np.asarray(q, dtype=float)
+        if len(x) == 0:
+            return None
+        if np.isnan(q).any():
+            for k in range(len(x)):
+                if self.collides(RRTNode(x=x[k], y=y[k], q=q[k])):
+                    return k
+            return None
+        keys = np.round(q / self.q_tol).astype(int)
+        pending = np.ones(len(x), dtype=bool)
+        if self.use_cspace_grid and self.cspace is not None:
+            pending &= ~self.cspace.free_mask(x, y, keys)
+        first = None
+        # Visit heading bins in path order so an early hit prunes the rest
+        (bins, starts) = np.unique(keys[pending], return_index=True)
+        for key in bins[np.argsort(starts)]:
+            indices = np.nonzero(pending & (keys == key))[0]
+            if first is not None:
+                indices = indices[indices < first]
+                if len(indices) == 0:
+                    continue
+            if len(indices) < self.min_batch:
+                for k in indices:
+                    if self.collides(RRTNode(x=x[k], y=y[k], q=q[k])):
+                        first = k
+                        break
+                continue
+            self.collision_checks += len(indices)
+            while len(indices) > 0:
+                hit = self.template_hit(key, x[indices], y[indices])
+                if hit is None:
+                    break
+                k = indices[hit]
+                if self.parts_collide(self.robot_parts_to_node(RRTNode(x=x[k], y=y[k], q=q[k]))):
+                    first = k
+                    break
+                indices = indices[hit+1:]
+        return None if first is None else int(first)
+
+    def template_hit(self, key, dx, dy):
+        """Index of the first of the translations (dx[k], dy[k]) at which
+        the template for heading bin key hits an obstacle, or None."""
+        obstacles = self.obstacles
+        tree = self.broad_phase()
+        first = None
+        (xmin, xmax, ymin, ymax) = (dx.min(), dx.max(), dy.min(), dy.max())
+        for part in self.footprint_template(key):
+            px = part.center[0,0]
+            py = part.center[1,0]
+            pr = part.bounding_radius
+            candidates = [obstacles[i] for i in
+                          tree.query(xmin+px-pr, xmax+px+pr, ymin+py-pr, ymax+py+pr)]
+            hit = collides_batch([part], candidates, dx, dy)
+            if hit is not None:
+                dx = dx[:hit]
+                dy = dy[:hit]
+                first = hit
+                if hit == 0:
+                    break
+        return first
+
+    def line_poses(self, x, y, q, dist):
+        "Poses every step_size along a straight line, excluding the start."
+        n = int(ceil(dist / self.step_size))
+        traveled = self.step_size * np.arange(1, n+1)
+        return (x + traveled*cos(q), y + traveled*sin(q), np.full(n, q))
 
     def plan_push_chip(self, start, goal, max_turn=20*(pi/180), arc_radius=40.):
         return self.plan_path(start, goal, max_turn, arc_radius)
 
     def plan_path(self, start, goal, max_turn=pi, arc_radius=40):
+        start_time = time.time()
+        self.collision_checks = 0
+        self.treeA = []
+        self.treeB = []
         self.max_turn = max_turn
         self.arc_radius = arc_radius
         if self.auto_obstacles:
             self.generate_obstacles()
+        if self.use_cspace_grid:
+            self.update_cspace()
         self.start = start
         self.goal = goal
         self.target_heading = goal.q
+        path = None
+        try:
+            (treeA, treeB, path) = self.cached_search(start, goal)
+        finally:
+            self.stats = dict(time = time.time() - start_time,
+                              nodes = len(self.treeA) + len(self.treeB),
+                              collision_checks = self.collision_checks,
+                              path_length = None if path is None else self.path_length(path))
+        return (treeA, treeB, path)
+
+    def cached_search(self, start, goal):
+        search = self.search_parallel if self.parallel > 1 else self.search
+        if not self.use_plan_cache:
+            return search(start, goal)
+        key = self.start_key(start) + self.goal_key(goal)
+        result = self.cached_plan(key, start)
+        if result is None:
+            result = search(start, goal)
+            (treeA, treeB, path) = result
+            self.plan_cache[key] = (treeA, treeB, self.copy_path(path))
+            while len(self.plan_cache) > self.plan_cache_size:
+                self.plan_cache.popitem(last=False)
+        return result
 
+    def search(self, start, goal):
         # Set up start node
         collider = self.collides(start)
         if collider:
             raise StartCollides(start,collider,collider.obstacle)
         else:
-            treeA = [start.copy()]
+            treeA = RRTTree([start.copy()])
             self.treeA = treeA
 
         # Set up goal node(s)
-        if not isnan(self.target_heading):
+        goal_key = self.goal_key(goal) if self.reuse_goal_tree else None
+        if self.reuse_goal_tree and self.goal_tree is not None and \
+               self.goal_tree_key == goal_key:
+            # Same goal in the same map: keep growing the old goal tree
+            treeB = self.goal_tree
+            self.treeB = treeB
+        elif not isnan(self.target_heading):
             offset_x = goal.x + center_of_rotation_offset * cos(goal.q)
             offset_y = goal.y + center_of_rotation_offset * sin(goal.q)
             offset_goal = RRTNode(x=offset_x, y=offset_y, q=goal.q)
-            treeB = [offset_goal]
+            treeB = RRTTree([offset_goal])
             self.treeB = treeB
             collider = self.collides(offset_goal)
             if collider:
                 raise GoalCollides(goal,collider,collider.obstacle)
         else:  # target_heading is nan
-            treeB = [goal.copy()]
+            treeB = RRTTree([goal.copy()])
             self.treeB = treeB
             temp_goal = goal.copy()
             offset_goal = goal.copy()
@@ -199,14 +805,23 @@ class RRT():
                     treeB.append(RRTNode(parent=treeB[0], x=temp_goal.x, y=temp_goal.y, q=temp_goal.q))
             if len(treeB) == 1:
                 raise GoalCollides(goal,collider,collider.obstacle)
+        if self.reuse_goal_tree:
+            self.goal_tree = treeB
+            self.goal_tree_key = goal_key
 
         # Set bounds for search area
         self.compute_world_bounds(start,goal)
+        self.sampler.setup(self, start, goal)
+
+        if self.anytime and self.max_turn >= pi:
+            return self.plan_anytime(treeA, treeB)
 
         # Grow the RRT until trees meet or max_iter exceeded
         swapped = False
         for i in range(self.max_iter):
-            r = self.random_node()
+            if self.should_stop is not None and self.should_stop():
+                raise MaxIterations(i)
+            r = self.random_node(treeB[0])
             (status, new_node) = self.extend(treeA, r)
             if status is not self.COLLISION:
                 (status, new_node) = self.extend(treeB, treeA[-1])
@@ -222,24 +837,372 @@ class RRT():
         else:
             raise MaxIterations(self.max_iter)
 
+    #---------------- Anytime RRT* ----------------
+
+    def plan_anytime(self, treeA, treeB):
+        """Grow a single tree from the start, RRT* style: each new node
+        takes the parent that gives it the shortest path, and then
+        neighbors are rewired through it when that shortens theirs.
+        Once a goal node has been reached, keep improving the best path
+        until time_budget seconds have passed, sampling only inside the
+        ellipse of points that could still shorten it if informed is
+        set.  Only straight segments with turns in place are produced,
+        so this requires max_turn >= pi."""
+        start_time = time.time()
+        root = treeA[0]
+        root.cost = 0
+        root.children = []
+        root.spin = dict()
+        if isnan(self.target_heading):
+            goals = treeB[1:]
+        else:
+            goals = treeB[0:1]
+        reached = dict()   # goal node -> tree node at the same spot
+        self.solution_history = []
+        best = None
+        best_cost = inf
+        i = 0
+        while True:
+            if self.should_stop is not None and self.should_stop():
+                raise MaxIterations(i)
+            if best is not None:
+                if time.time() - start_time > self.time_budget:
+                    break
+            elif i >= self.max_iter:
+                raise MaxIterations(self.max_iter)
+            i += 1
+            (x, y) = self.anytime_sample(root, goals, best)
+            nearest = treeA.nearest(x, y)
+            dx = x - nearest.x
+            dy = y - nearest.y
+            dist = sqrt(dx*dx + dy*dy)
+            if dist < 1:
+                continue
+            if dist > self.star_step:
+                x = nearest.x + dx * self.star_step / dist
+                y = nearest.y + dy * self.star_step / dist
+            radius = self.near_radius(len(treeA))
+            node = self.star_insert(treeA, x, y, radius, nearest)
+            if node is None:
+                continue
+            for goal in goals:
+                if goal in reached:
+                    continue
+                if (goal.x-node.x)**2 + (goal.y-node.y)**2 <= radius*radius:
+                    goal_node = self.star_insert(treeA, goal.x, goal.y, radius, node)
+                    if goal_node is not None:
+                        reached[goal] = goal_node
+            for (goal, goal_node) in reached.items():
+                if goal_node.cost < best_cost - 1e-6:
+                    best = (goal_node, goal)
+                    best_cost = goal_node.cost
+                    self.solution_history.append((time.time()-start_time, i, best_cost))
+        self.best_cost = best_cost
+        return self.get_path(treeA, treeB, *best)
+
+    def anytime_sample(self, root, goals, best):
+        if self.rng.random() < self.goal_bias:
+            goal = self.rng.choice(goals)
+            return (goal.x, goal.y)
+        if best is None or not self.informed:
+            node = self.random_node()
+            return (node.x, node.y)
+        # Uniform sample from the ellipse with the start and the best
+        # goal as foci, whose points are no farther than the best cost.
+        (goal_node, goal) = best
+        c_best = goal_node.cost
+        dx = goal.x - root.x
+        dy = goal.y - root.y
+        c_min = sqrt(dx*dx + dy*dy)
+        a = c_best / 2
+        b = sqrt(max(c_best*c_best - c_min*c_min, 0)) / 2
+        r = sqrt(self.rng.random())
+        theta = 2 * pi * self.rng.random()
+        ex = a * r * cos(theta)
+        ey = b * r * sin(theta)
+        phi = atan2(dy, dx)
+        return (root.x + dx/2 + ex*cos(phi) - ey*sin(phi),
+                root.y + dy/2 + ex*sin(phi) + ey*cos(phi))
+
+    def near_radius(self, n):
+        "Shrinking RRT* neighborhood radius, capped at a few steps."
+        (xrange, yrange) = self.bounds
+        gamma = 2 * sqrt(1.5 * len(xrange) * len(yrange) / pi)
+        return min(gamma * sqrt(log(n+1) / (n+1)), 3*self.star_step)
+
+    def star_insert(self, tree, x, y, radius, nearest):
+        """Add a node at (x,y) with the cheapest collision-free parent
+        among its neighbors, then rewire the neighbors through it.
+        Returns the new node, or None if no parent can reach it."""
+        near = tree.near(x, y, radius)
+        if nearest not in near:
+            near.append(nearest)
+        candidates = []
+        for node in near:
+            dist = sqrt((x-node.x)**2 + (y-node.y)**2)
+            candidates.append((node.cost + dist, dist, node))
+        candidates.sort(key=lambda c: c[0])
+        for (cost, dist, parent) in candidates:
+            if self.edge_free(parent, parent.q, x, y):
+                break
+        else:
+            return None
+        new_node = RRTNode(parent=parent, x=x, y=y, q=atan2(y-parent.y, x-parent.x))
+        new_node.cost = cost
+        new_node.children = []
+        new_node.spin = dict()
+        parent.children.append(new_node)
+        tree.append(new_node)
+        for node in near:
+            if node is parent or node.parent is None:
+                continue
+            dist = sqrt((x-node.x)**2 + (y-node.y)**2)
+            if new_node.cost + dist >= node.cost - 1e-6:
+                continue
+            q = atan2(node.y-y, node.x-x)
+            # The new heading into node must still let it turn toward
+            # each of its children.
+            if not all(self.turn_free(node, q, child.q) for child in node.children):
+                continue
+            if not self.edge_free(new_node, new_node.q, node.x, node.y):
+                continue
+            node.parent.children.remove(node)
+            node.parent = new_node
+            node.q = q
+            new_node.children.append(node)
+            self.propagate_cost(node, new_node.cost + dist)
+        return new_node
+
+    def propagate_cost(self, node, cost):
+        node.cost = cost
+        stack = [node]
+        while stack:
+            parent = stack.pop()
+            for child in parent.children:
+                child.cost = parent.cost + sqrt((child.x-parent.x)**2 + (child.y-parent.y)**2)
+                stack.append(child)
+
+    def turn_free(self, node, q0, q1):
+        """True if the robot can turn in place at node from heading q0
+        to q1, checking every q_tol as interpolate() does.  Heading bins
+        whose grown template is clear at node are memoized in node.spin;
+        the others need an exact test at each heading."""
+        dq = wrap_angle(q1 - q0)
+        if not abs(dq) >= self.q_tol:
+            return True
+        turn_dir = +1 if dq >= 0 else -1
+        q_inc = turn_dir * self.q_tol
+        while abs(q_inc - dq) > self.q_tol:
+            q = q0 + q_inc
+            key = round(q / self.q_tol)
+            if not node.spin.get(key, False):
+                if self.template_free(node.x, node.y, key):
+                    node.spin[key] = True
+                elif self.collides(RRTNode(x=node.x, y=node.y, q=q)):
+                    return False
+            q_inc += turn_dir * self.q_tol
+        return True
+
+    def edge_free(self, node, q0, x, y):
+        "Turn in place at node from heading q0, then drive straight to (x,y)."
+        dx = x - node.x
+        dy = y - node.y
+        dist = sqrt(dx*dx + dy*dy)
+        q = atan2(dy, dx)
+        if not self.turn_free(node, q0, q):
+            return False
+        n = int(ceil(dist / self.step_size))
+        traveled = np.minimum(self.step_size * np.arange(1, n+1), dist)
+        return self.collides_batch(node.x + traveled*cos(q), node.y + traveled*sin(q),
+                                   np.full(n, q)) is None
+
+    #---------------- Parallel Planning ----------------
+
+    def snapshot(self):
+        """Picklable copy of the planner settings, robot parts, and
+        obstacles, for planning in another process.  The obstacles'
+        links back to world map objects are dropped; errors refer to
+        obstacles by their index in self.obstacles instead."""
+        def detached(shape):
+            shape = copy.copy(shape)
+            shape.obstacle = None
+            if isinstance(shape, Compound):
+                shape.shapes = [detached(s) for s in shape.shapes]
+            return shape
+        settings = dict(max_iter=self.max_iter, step_size=self.step_size,
+                        arc_radius=self.arc_radius, xy_tolsq=self.xy_tolsq,
+                        q_tol=self.q_tol, use_cspace_grid=self.use_cspace_grid,
+                        grid_cell_size=self.grid_cell_size, anytime=self.anytime,
+                        time_budget=self.time_budget, informed=self.informed,
+                        sampler=self.sampler)
+        return dict(settings = settings,
+                    robot_parts = [detached(part) for part in self.robot_parts],
+                    obstacles = [detached(obst) for obst in self.obstacles])
+
+    @classmethod
+    def from_snapshot(cls, snapshot):
+        rrt = cls(None, auto_obstacles=False, use_plan_cache=False,
+                  **snapshot['settings'])
+        rrt.robot_parts = snapshot['robot_parts']
+        rrt.set_obstacles(snapshot['obstacles'])
+        return rrt
+
+    def search_parallel(self, start, goal):
+        """Run self.parallel independently seeded searches in worker
+        processes.  Returns the first path found, or if
+        parallel_deadline is set, the shortest one found by then.
+        Searches still running are told to quit, and their collision
+        checks are added to ours once they have.  Workers are spawned
+        rather than forked, since the caller may have threads running
+        (the SDK event loop, the viewers) that a fork would copy in
+        whatever state they happen to be in."""
+        if self.executor is None:
+            context = multiprocessing.get_context('spawn')
+            self.generation = context.RawValue('i', 0)
+            self.executor = ProcessPoolExecutor(max_workers=self.parallel,
+                                                mp_context=context,
+                                                initializer=init_plan_worker,
+                                                initargs=(self.generation,))
+        self.generation.value += 1
+        generation = self.generation.value
+        snapshot = self.snapshot()
+        seed = self.rng.randrange(1 << 30)
+        pending = set(self.executor.submit(plan_worker, snapshot, start, goal,
+                                           self.max_turn, self.arc_radius,
+                                           seed+k, generation)
+                      for k in range(self.parallel))
+        if self.parallel_deadline is None:
+            deadline = None
+        else:
+            deadline = time.time() + self.parallel_deadline
+        best = None
+        best_length = inf
+        failure = None
+        try:
+            while pending:
+                if best is not None and (deadline is None or time.time() >= deadline):
+                    break
+                timeout = None if best is None else deadline - time.time()
+                (done, pending) = wait(pending, timeout=timeout,
+                                       return_when=FIRST_COMPLETED)
+                for future in done:
+                    (checks, result) = future.result()
+                    self.collision_checks += checks
+                    if result[0] != 'path':
+                        if failure is None or result[0] != 'MaxIterations':
+                            failure = result
+                        continue
+                    path = unpack_nodes(result[1], chain=True)
+                    length = self.path_length(path)
+                    if length < best_length:
+                        best = (result, path)
+                        best_length = length
+        finally:
+            self.generation.value += 1
+            for future in pending:
+                future.cancel()
+        for future in wait(pending).done:
+            if not future.cancelled():
+                self.collision_checks += future.result()[0]
+        if best is None:
+            (kind, arg) = failure
+            if kind == 'MaxIterations':
+                raise MaxIterations(self.max_iter)
+            collider = self.obstacles[arg]
+            exception = StartCollides if kind == 'StartCollides' else GoalCollides
+            raise exception(start if exception is StartCollides else goal,
+                            collider, collider.obstacle)
+        (result, path) = best
+        self.treeA = unpack_nodes(result[2], RRTTree())
+        self.treeB = unpack_nodes(result[3], RRTTree())
+        self.path = path
+        return (self.treeA, self.treeB, self.path)
+
+    def close(self):
+        "Shut down the process pool used for parallel planning."
+        if self.executor is not None:
+            self.executor.shutdown(wait=False)
+            self.executor = None
+
+    #---------------- Plan Cache ----------------
+
+    def start_key(self, start):
+        return (round(start.x / self.cache_cell), round(start.y / self.cache_cell),
+                None if isnan(start.q) else round(start.q / self.q_tol))
+
+    def goal_key(self, goal):
+        return (round(goal.x, 1), round(goal.y, 1),
+                None if isnan(goal.q) else round(goal.q, 4),
+                self.max_turn, self.arc_radius, self.anytime,
+                tuple(CSpaceGrid.signature(obst) for obst in self.obstacles))
+
+    def cached_plan(self, key, start):
+        """Return a copy of the cached plan for key, with its first node
+        moved to the actual start pose, or None if there is no plan or
+        the first leg is no longer clear from the new start."""
+        entry = self.plan_cache.get(key, None)
+        if entry is None:
+            return None
+        (treeA, treeB, path) = entry
+        first = start.copy()
+        first.spin = dict()
+        path = [first] + self.copy_path(path[1:])
+        if len(path) > 1:
+            second = path[1]
+            if second.radius is not None:
+                return None
+            q = atan2(second.y - first.y, second.x - first.x)
+            if abs(wrap_angle(q - first.q)) > self.max_turn or \
+                   not self.edge_free(first, first.q, second.x, second.y):
+                return None
+            # The robot now reaches the second node on a new heading, so
+            # check the turn back onto the cached plan's heading there.
+            second.spin = dict()
+            if not self.turn_free(second, q, second.q):
+                return None
+            second.parent = first
+            second.q = q
+        self.plan_cache.move_to_end(key)
+        self.treeA = treeA
+        self.treeB = treeB
+        self.path = path
+        return (treeA, treeB, path)
+
+    @staticmethod
+    def copy_path(path):
+        "Copies of the nodes in path, each one's parent the copy before it."
+        copies = []
+        for node in path:
+            copy = node.copy()
+            if copies:
+                copy.parent = copies[-1]
+            copies.append(copy)
+        return copies
+
+    @staticmethod
+    def path_length(path):
+        return sum(sqrt((b.x-a.x)**2 + (b.y-a.y)**2) for (a,b) in zip(path, path[1:]))
+
     def compute_world_bounds(self,start,goal):
         xmin = min(start.x, goal.x)
         xmax = max(start.x, goal.x)
         ymin = min(start.y, goal.y)
         ymax = max(start.y, goal.y)
         for obst in self.obstacles:
-            xmin = min(xmin, np.min(obst.vertices[0]))
-            xmax = max(xmax, np.max(obst.vertices[0]))
-            ymin = min(ymin, np.min(obst.vertices[1]))
-            ymax = max(ymax, np.max(obst.vertices[1]))
+            (obst_xmin, obst_xmax, obst_ymin, obst_ymax) = obst.extent()
+            xmin = min(xmin, obst_xmin)
+            xmax = max(xmax, obst_xmax)
+            ymin = min(ymin, obst_ymin)
+            ymax = max(ymax, obst_ymax)
         xmin = xmin - 500
         xmax = xmax + 500
         ymin = ymin - 500
         ymax = ymax + 500
         self.bounds = (range(int(xmin), int(xmax)), range(int(ymin), int(ymax)))        
 
-    def get_path(self, treeA, treeB):
-        nodeA = treeA[-1]
+    def get_path(self, treeA, treeB, nodeA=None, nodeB=None):
+        if nodeA is None:
+            nodeA = treeA[-1]
         pathA = [nodeA.copy()]
         while nodeA.parent is not None:
             nodeA = nodeA.parent
@@ -247,16 +1210,20 @@ class RRT():
         pathA.reverse()
         # treeB was built backwards from the goal, so headings
         # need to be reversed
-        nodeB = treeB[-1]
+        if nodeB is None:
+            nodeB = treeB[-1]
         prev_heading = wrap_angle(nodeB.q + pi)
         if nodeB.parent is None:
             pathB = [nodeB.copy()]
         else:
             pathB = []
             while nodeB.parent is not None:
+                # Reverse headings on copies; treeB itself must stay
+                # intact in case it is reused for the next query.
                 nodeB = nodeB.parent
-                (nodeB.q, prev_heading) = (prev_heading, wrap_angle(nodeB.q+pi))
-                pathB.append(nodeB.copy())
+                node = nodeB.copy()
+                (node.q, prev_heading) = (prev_heading, wrap_angle(nodeB.q+pi))
+                pathB.append(node)
         (pathA,pathB) = self.join_paths(pathA,pathB)
         self.path = pathA + pathB
         self.smooth_path()
@@ -283,11 +1250,11 @@ class RRT():
         for _ in range(0,len(smoothed_path)):
             L = len(smoothed_path)
             if L == 2: break
-            i = random.randrange(0,L-2)
+            i = self.rng.randrange(0,L-2)
             cur_x = smoothed_path[i].x
             cur_y = smoothed_path[i].y
             cur_q = smoothed_path[i].q
-            j = random.randrange(i+2, L)
+            j = self.rng.randrange(i+2, L)
             if j < L-1 and smoothed_path[j+1].radius != None:
                 continue  # j is parent node of an arc segment: don't touch
             dx = smoothed_path[j].x - cur_x
@@ -303,15 +1270,8 @@ class RRT():
         self.path = smoothed_path
 
     def try_linear_smooth(self,smoothed_path,i,j,cur_x,cur_y,new_q,dist):
-        step_x = self.step_size * cos(new_q)
-        step_y = self.step_size * sin(new_q)
-        traveled = 0
-        while traveled < dist:
-            traveled += self.step_size
-            cur_x += step_x
-            cur_y += step_y
-            if self.collides(RRTNode(None, cur_x, cur_y, new_q)):
-                return None
+        if self.collides_batch(*self.line_poses(cur_x, cur_y, new_q, dist)) is not None:
+            return None
         # Since we're arriving at node j via a different heading than
         # before, see if we need to add an arc to get us to node k=j+1
         node_i = smoothed_path[i]
@@ -403,13 +1363,11 @@ class RRT():
         else:
             (tang_x,tang_y,tang_q,turn) = (tang_x2,tang_y2,tang_q2,turn2)
         # Interpolate along the arc and check for collision.
-        q_traveled = 0
-        while abs(q_traveled) < abs(turn):
-            cur_x = cx + self.arc_radius * cos(cur_q + q_traveled)
-            cur_y = cy + self.arc_radius * sin(cur_q + q_traveled)
-            if self.collides(RRTNode(None, cur_x, cur_y, cur_q+q_traveled)):
-                return None
-            q_traveled += dir * self.q_tol
+        q_traveled = dir * self.q_tol * np.arange(int(ceil(abs(turn) / self.q_tol)))
+        arc_x = cx + self.arc_radius * np.cos(cur_q + q_traveled)
+        arc_y = cy + self.arc_radius * np.sin(cur_q + q_traveled)
+        if self.collides_batch(arc_x, arc_y, cur_q + q_traveled) is not None:
+            return None
         # Now interpolate from the tangent point to the target.
         cur_x = tang_x
         cur_y = tang_y
@@ -417,15 +1375,8 @@ class RRT():
         dy = dest_y - cur_y
         new_q = atan2(dy, dx)
         dist = sqrt(dx*dx + dy*dy)
-        step_x = self.step_size * cos(new_q)
-        step_y = self.step_size * sin(new_q)
-        traveled = 0
-        while traveled < dist:
-            traveled += self.step_size
-            cur_x += step_x
-            cur_y += step_y
-            if self.collides(RRTNode(None, cur_x, cur_y, new_q)):
-                return None
+        if self.collides_batch(*self.line_poses(cur_x, cur_y, new_q, dist)) is not None:
+            return None
         # No collision, so arc is good.
         return (tang_x, tang_y, tang_q, dir*self.arc_radius)
 
@@ -457,7 +1408,8 @@ class RRT():
     def generate_obstacles(self):
         self.robot.world.world_map.update_map()
         obstacles = []
-        for obj in self.robot.world.world_map.objects.values():
+        obstacle_types = (WallObj, LightCubeObj, CustomCubeObj, ChargerObj, ChipObj, RobotForeignObj)
+        for obj in self.robot.world.world_map.objects.of_type(*obstacle_types):
             if not obj.is_obstacle: continue
             if self.robot.carrying is obj: continue
             if obj.pose_confidence < 0: continue
@@ -470,9 +1422,10 @@ class RRT():
             elif isinstance(obj, RobotForeignObj):
                obstacles.append(self.generate_foreign_obstacle(obj))
         self.obstacles = obstacles
+        self.obstacle_tree = AABBTree(obstacles)
 
     def generate_wall_obstacles(self,wall):
-        wall_spec = wall_marker_dict[wall.id]
+        wall_spec = wall_marker_dict[wall.id[5:]]
         half_length = wall.length / 2
         widths = []
         last_x = -half_length
@@ -530,3 +1483,50 @@ class RRT():
                 result.append(robot_obst)
         return result
 
+
+#---------------- Parallel Planning Workers ----------------
+
+def pack_nodes(nodes):
+    """Flatten RRTNodes to tuples with parents as list indices (-1 if
+    not in the list), so a tree can be pickled without recursing down
+    long parent chains."""
+    index = dict((id(node), i) for (i, node) in enumerate(nodes))
+    return [(node.x, node.y, node.q, node.radius, index.get(id(node.parent), -1))
+            for node in nodes]
+
+def unpack_nodes(packed, nodes=None, chain=False):
+    """Rebuild RRTNodes from pack_nodes, appending them to nodes.  With
+    chain set, each node's parent is the one before it, as in a path."""
+    nodes = [] if nodes is None else nodes
+    for (i, (x, y, q, radius, parent)) in enumerate(packed):
+        if chain:
+            parent = nodes[i-1] if i > 0 else None
+        else:
+            parent = nodes[parent] if parent >= 0 else None
+        nodes.append(RRTNode(parent, x, y, q, radius))
+    return nodes
+
+plan_generation = None
+
+def init_plan_worker(generation):
+    global plan_generation
+    plan_generation = generation
+
+def plan_worker(snapshot, start, goal, max_turn, arc_radius, seed, generation):
+    """Runs in a pool process.  Returns the number of collision checks
+    made, and either ('path', path, treeA, treeB) with packed nodes or
+    the kind of failure plus its argument."""
+    rrt = RRT.from_snapshot(snapshot)
+    if plan_generation is not None:
+        rrt.should_stop = lambda: plan_generation.value != generation
+    rrt.rng.seed(seed)
+    try:
+        (treeA, treeB, path) = rrt.plan_path(start, goal, max_turn, arc_radius)
+    except (StartCollides, GoalCollides) as e:
+        collider = e.args[1]
+        index = next(i for (i, obst) in enumerate(rrt.obstacles) if obst is collider)
+        return (rrt.collision_checks, (type(e).__name__, index))
+    except MaxIterations as e:
+        return (rrt.collision_checks, ('MaxIterations', e.args[0]))
+    return (rrt.collision_checks,
+            ('path', pack_nodes(path), pack_nodes(treeA), pack_nodes(treeB)))
@@ -23,6 +23,11 @@ class Shape():
         else:
             raise Exception("%s has no collides() method defined for %s." % (self, shape))
 
+    def extent(self):
+        """Axis-aligned bounding box (xmin, xmax, ymin, ymax)."""
+        return (np.min(self.vertices[0]), np.max(self.vertices[0]),
+                np.min(self.vertices[1]), np.max(self.vertices[1]))
+
 #================ Basic Shapes ================
 
 class Circle(Shape):
@@ -30,6 +35,7 @@ class Circle(Shape):
         super().__init__()
         self.center = center
         self.radius = radius
+        self.bounding_radius = radius
         self.orient = 0.
 
     def __repr__(self):
@@ -39,6 +45,17 @@ class Circle(Shape):
     def instantiate(self, tmat):
         return Circle(center=tmat.dot(self.center), radius=self.radius)        
 
+    def translated(self, dx, dy):
+        return Circle(center=self.center + np.array([[dx], [dy], [0], [0]]),
+                      radius=self.radius)
+
+    def inflated(self, margin):
+        return Circle(center=self.center, radius=self.radius+margin)
+
+    def extent(self):
+        (x, y, r) = (self.center[0,0], self.center[1,0], self.radius)
+        return (x-r, x+r, y-r, y+r)
+
     def collides_rect(self,rect):
         return rect.collides_circle(self)
         
@@ -75,16 +92,17 @@ class Rectangle(Polygon):
                              [-dy2, -dy2, dy2,  dy2 ],
                              [  0,    0,   0,    0  ],
                              [  1,    1,   1,    1  ]])
+        self.bounding_radius = sqrt(dx2*dx2 + dy2*dy2)
         self.unrot = transform.aboutZ(-orient)
         center_ex = self.unrot.dot(center)
-        extents = transform.translate(center_ex[0],center_ex[1]).dot(vertices)
+        extents = transform.translate(center_ex[0,0],center_ex[1,0]).dot(vertices)
         # Extents measured along the rectangle's axes, not world axes
         self.min_Ex = min(extents[0,:])
         self.max_Ex = max(extents[0,:])
         self.min_Ey = min(extents[1,:])
         self.max_Ey = max(extents[1,:])
         world_vertices = transform.aboutZ(orient).dot(vertices)
-        world_vertices = transform.translate(center[0],center[1]).dot(world_vertices)
+        world_vertices = transform.translate(center[0,0],center[1,0]).dot(world_vertices)
         super().__init__(vertices=world_vertices)
 
     def __repr__(self):
@@ -99,6 +117,37 @@ class Rectangle(Polygon):
                          orient = rot + self.orient,
                          dimensions = dimensions)
 
+    def translated(self, dx, dy):
+        """Copy of this rectangle moved by (dx,dy).  Rotation is
+        unchanged, so the vertices and extents just shift; this is much
+        cheaper than building a new Rectangle."""
+        result = Rectangle.__new__(Rectangle)
+        offset = np.array([[dx], [dy], [0], [0]])
+        result.center = self.center + offset
+        result.dimensions = self.dimensions
+        result.orient = self.orient
+        result.bounding_radius = self.bounding_radius
+        result.unrot = self.unrot
+        ex = self.unrot[0,0]*dx + self.unrot[0,1]*dy
+        ey = self.unrot[1,0]*dx + self.unrot[1,1]*dy
+        result.min_Ex = self.min_Ex + ex
+        result.max_Ex = self.max_Ex + ex
+        result.min_Ey = self.min_Ey + ey
+        result.max_Ey = self.max_Ey + ey
+        result.vertices = self.vertices + offset
+        N = result.vertices.shape[1]
+        result.edges = tuple( (result.vertices[:,i:i+1], result.vertices[:,(i+1)%N:((i+1)%N)+1])
+                              for i in range(N) )
+        return result
+
+    def inflated(self, margin):
+        """Rectangle grown by margin on every side.  It contains every
+        point within margin of this rectangle."""
+        return Rectangle(center=self.center,
+                         dimensions=(self.max_Ex-self.min_Ex+2*margin,
+                                     self.max_Ey-self.min_Ey+2*margin),
+                         orient=self.orient)
+
     def collides_rect(self,other):
         # Test others edges in our reference frame
         o_verts = self.unrot.dot(other.vertices)
@@ -124,14 +173,13 @@ class Rectangle(Polygon):
         return True
             
     def collides_circle(self,circle):
+        # Distance from the circle's center to the nearest point of the
+        # rectangle, in the rectangle's frame.  This is exact near the
+        # corners, where testing the circle's bounding square is not.
         p = self.unrot.dot(circle.center)[0:2,0]
-        pmin = p - circle.radius
-        pmax = p + circle.radius
-        if pmax[0] <= self.min_Ex or self.max_Ex <= pmin[0] or \
-           pmax[1] <= self.min_Ey or self.max_Ey <= pmin[1]:
-            return False
-        # Need corner tests here
-        return True
+        dx = p[0] - min(max(p[0], self.min_Ex), self.max_Ex)
+        dy = p[1] - min(max(p[1], self.min_Ey), self.max_Ey)
+        return dx*dx + dy*dy < circle.radius*circle.radius
 
 #================ Compound Shapes ================
 
@@ -145,3 +193,146 @@ class Compound(Shape):
                 return True
         return False
 
+    def inflated(self, margin):
+        return Compound([s.inflated(margin) for s in self.shapes])
+
+    def extent(self):
+        extents = np.array([s.extent() for s in self.shapes])
+        return (extents[:,0].min(), extents[:,1].max(),
+                extents[:,2].min(), extents[:,3].max())
+
+#================ Broad Phase ================
+
+class AABBTree():
+    """Bounding-volume hierarchy of axis-aligned boxes over a list of
+    shapes, for broad-phase collision culling.  query() returns the
+    indices of the shapes whose boxes overlap a box, in list order, so
+    callers see candidates in the same order as a linear scan."""
+    leaf_size = 4
+
+    def __init__(self, shapes):
+        self.shapes = shapes
+        self.boxes = np.array([s.extent() for s in shapes], dtype=float).reshape(-1,4)
+        self.box_list = self.boxes.tolist()
+        if len(shapes) > 0:
+            self.root = self.build(np.arange(len(shapes)))
+        else:
+            self.root = None
+
+    def build(self, indices):
+        boxes = self.boxes[indices]
+        box = (float(boxes[:,0].min()), float(boxes[:,1].max()),
+               float(boxes[:,2].min()), float(boxes[:,3].max()))
+        if len(indices) <= self.leaf_size:
+            return (box, indices.tolist(), None, None)
+        # Split at the median center along the longer side.
+        if box[1]-box[0] >= box[3]-box[2]:
+            centers = boxes[:,0] + boxes[:,1]
+        else:
+            centers = boxes[:,2] + boxes[:,3]
+        order = indices[np.argsort(centers, kind='stable')]
+        half = len(order) // 2
+        return (box, None, self.build(order[:half]), self.build(order[half:]))
+
+    def query(self, xmin, xmax, ymin, ymax):
+        result = []
+        if self.root is None:
+            return result
+        boxes = self.box_list
+        stack = [self.root]
+        while stack:
+            (box, indices, left, right) = stack.pop()
+            if box[1] < xmin or xmax < box[0] or box[3] < ymin or ymax < box[2]:
+                continue
+            if indices is None:
+                stack.append(left)
+                stack.append(right)
+            else:
+                for i in indices:
+                    b = boxes[i]
+                    if not (b[1] < xmin or xmax < b[0] or b[3] < ymin or ymax < b[2]):
+                        result.append(i)
+        result.sort()
+        return result
+
+#================ Vectorized Tests ================
+
+def collides_translated(shape, obstacle, dx, dy):
+    """Vectorized shape.collides(obstacle) for copies of shape
+    translated by (dx[k], dy[k]).  Returns a boolean array.  Only the
+    translation varies, so each separating-axis test reduces to the
+    fixed projections of the two shapes plus a per-copy offset."""
+    if isinstance(obstacle, Compound):
+        result = np.zeros(np.shape(dx), dtype=bool)
+        for s in obstacle.shapes:
+            result |= collides_translated(shape, s, dx, dy)
+        return result
+    if isinstance(shape, Rectangle) and isinstance(obstacle, Rectangle):
+        # Obstacle's vertices in our frame, against our shifted extents
+        u = shape.unrot
+        ex = u[0,0]*dx + u[0,1]*dy
+        ey = u[1,0]*dx + u[1,1]*dy
+        o_verts = u.dot(obstacle.vertices)
+        separated = (o_verts[0].max() <= shape.min_Ex + ex) | \
+                    (shape.max_Ex + ex <= o_verts[0].min()) | \
+                    (o_verts[1].max() <= shape.min_Ey + ey) | \
+                    (shape.max_Ey + ey <= o_verts[1].min())
+        if shape.orient != obstacle.orient:
+            # Our shifted vertices in the obstacle's frame
+            u = obstacle.unrot
+            ex = u[0,0]*dx + u[0,1]*dy
+            ey = u[1,0]*dx + u[1,1]*dy
+            s_verts = u.dot(shape.vertices)
+            separated |= (s_verts[0].max() + ex <= obstacle.min_Ex) | \
+                         (obstacle.max_Ex <= s_verts[0].min() + ex) | \
+                         (s_verts[1].max() + ey <= obstacle.min_Ey) | \
+                         (obstacle.max_Ey <= s_verts[1].min() + ey)
+        return ~separated
+    if isinstance(shape, Rectangle) and isinstance(obstacle, Circle):
+        # Circle's center relative to the shifted rectangle, in its frame
+        u = shape.unrot
+        p = u.dot(obstacle.center)[0:2,0]
+        px = p[0] - (u[0,0]*dx + u[0,1]*dy)
+        py = p[1] - (u[1,0]*dx + u[1,1]*dy)
+        return circle_hits_extents(px, py, obstacle.radius, shape)
+    if isinstance(shape, Circle) and isinstance(obstacle, Rectangle):
+        u = obstacle.unrot
+        p = u.dot(shape.center)[0:2,0]
+        px = p[0] + u[0,0]*dx + u[0,1]*dy
+        py = p[1] + u[1,0]*dx + u[1,1]*dy
+        return circle_hits_extents(px, py, shape.radius, obstacle)
+    if isinstance(shape, Circle) and isinstance(obstacle, Circle):
+        cx = shape.center[0,0] + dx - obstacle.center[0,0]
+        cy = shape.center[1,0] + dy - obstacle.center[1,0]
+        reach = shape.radius + obstacle.radius
+        return cx*cx + cy*cy < reach*reach
+    raise Exception("No vectorized collision test for %s against %s." % (shape, obstacle))
+
+def circle_hits_extents(px, py, r, rect):
+    """Vectorized Rectangle.collides_circle for circles of radius r
+    centered at (px[k], py[k]) in the rectangle's frame."""
+    ex = px - np.clip(px, rect.min_Ex, rect.max_Ex)
+    ey = py - np.clip(py, rect.min_Ey, rect.max_Ey)
+    return ex*ex + ey*ey < r*r
+
+def collides_batch(shapes, obstacles, dx, dy):
+    """Test copies of the shapes translated by (dx[k], dy[k]) against
+    all the obstacles at once.  Returns the first k at which any shape
+    collides with any obstacle, or None if all are clear.  Pairs whose
+    bounding circles don't overlap are skipped, as in RRT.collides;
+    every shape lies inside its bounding circle, so this never changes
+    the answer."""
+    hits = np.zeros(np.shape(dx), dtype=bool)
+    for shape in shapes:
+        sr = getattr(shape, 'bounding_radius', None)
+        for obstacle in obstacles:
+            hit = collides_translated(shape, obstacle, dx, dy)
+            obr = getattr(obstacle, 'bounding_radius', None)
+            if sr is not None and obr is not None:
+                cx = shape.center[0,0] + dx - obstacle.center[0,0]
+                cy = shape.center[1,0] + dy - obstacle.center[1,0]
+                hit &= cx*cx + cy*cy < (sr+obr)**2
+            hits |= hit
+    if hits.any():
+        return int(np.argmax(hits))
+    return None
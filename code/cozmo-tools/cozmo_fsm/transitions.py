@@ -180,24 +180,29 @@ class DataTrans(Transition):
             raise TypeError('%s is not a DataEvent' % event)
 
 class ArucoTrans(Transition):
-    """Fires if one of the specified markers is visible"""
+    """Fires if one of the specified markers is visible.  Driven by the
+    ArucoEvent posted for each camera image that contains markers."""
     def __init__(self,marker_ids=None):
         super().__init__()
-        self.polling_interval = 0.1
         if isinstance(marker_ids,(list,tuple)):
             marker_ids = set(marker_ids)
         self.marker_ids = marker_ids
 
-    def poll(self,event=None):
+    def start(self):
+        if self.running: return
+        super().start()
+        self.robot.erouter.add_listener(self,ArucoEvent,None)
+
+    def handle_event(self,event):
         if not self.running: return
         if self.marker_ids is None:
-            if self.robot.world.aruco.seen_marker_ids != []:
-                self.fire()
+            if event.marker_ids:
+                self.fire(event)
         elif isinstance(self.marker_ids,set):
-            if self.marker_ids.intersection(self.robot.world.aruco.seen_marker_ids) != set():
-                self.fire()
-        elif self.marker_ids in self.robot.world.aruco.seen_marker_ids:
-            self.fire()
+            if not self.marker_ids.isdisjoint(event.markers):
+                self.fire(event)
+        elif self.marker_ids in event.markers:
+            self.fire(event)
 
 
 class PatternMatchTrans(Transition):
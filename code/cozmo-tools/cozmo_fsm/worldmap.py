@@ -1,5 +1,8 @@
-from math import pi, inf, sin, cos, tan, atan2, sqrt
+import numpy as np
+import weakref
+from math import pi, inf, sin, cos, tan, atan2, sqrt, floor, isfinite
 from cozmo.faces import Face
+from cozmo.util import Pose
 from cozmo.objects import LightCube, CustomObject, EvtObjectMovingStopped
 
 from . import evbase
@@ -8,6 +11,15 @@ from . import custom_objs
 from .transform import wrap_angle
 
 class WorldObject():
+    # object -> spatial grids holding it, so that moves can be reported
+    grids = weakref.WeakKeyDictionary()
+
+    def __setattr__(self, name, value):
+        object.__setattr__(self, name, value)
+        if name == 'x' or name == 'y':
+            for grid in WorldObject.grids.get(self, ()):
+                grid.move(self)
+
     def __init__(self, id=None, x=0, y=0, z=0, is_visible=None):
         self.id = id
         self.x = x
@@ -334,13 +346,255 @@ class LightCubeForeignObj(WorldObject):
 
 #================ WorldMap ================
 
+#================ Object Indexes ================
+
+class SpatialGrid():
+    """Uniform grid over the (x,y) positions of world objects, for range
+    and nearest-object queries.  WorldObjects report their own moves;
+    objects with non-finite coordinates are held but never found."""
+    def __init__(self, cell_size=200):
+        self.cell_size = cell_size
+        self.cells = dict()     # (i,j) -> set of objects
+        self.where = dict()     # object -> (i,j) or None
+        self.refs = dict()      # object -> number of adds
+
+    def __len__(self):
+        return len(self.where)
+
+    def cell_of(self, x, y):
+        if not (isfinite(x) and isfinite(y)):
+            return None
+        return (floor(x / self.cell_size), floor(y / self.cell_size))
+
+    def add(self, obj):
+        self.refs[obj] = self.refs.get(obj,0) + 1
+        if self.refs[obj] > 1:
+            return
+        cell = self.cell_of(obj.x, obj.y)
+        self.where[obj] = cell
+        if cell is not None:
+            self.cells.setdefault(cell, set()).add(obj)
+        if isinstance(obj, WorldObject):
+            WorldObject.grids.setdefault(obj, []).append(self)
+
+    def remove(self, obj):
+        self.refs[obj] -= 1
+        if self.refs[obj] > 0:
+            return
+        del self.refs[obj]
+        self.unfile(obj, self.where.pop(obj))
+        grids = WorldObject.grids.get(obj, None)
+        if grids is not None:
+            grids.remove(self)
+            if not grids:
+                del WorldObject.grids[obj]
+
+    def unfile(self, obj, cell):
+        if cell is not None:
+            members = self.cells[cell]
+            members.discard(obj)
+            if not members:
+                del self.cells[cell]
+
+    def move(self, obj):
+        old_cell = self.where.get(obj, False)
+        if old_cell is False or not (hasattr(obj,'x') and hasattr(obj,'y')):
+            return
+        cell = self.cell_of(obj.x, obj.y)
+        if cell != old_cell:
+            self.unfile(obj, old_cell)
+            self.where[obj] = cell
+            if cell is not None:
+                self.cells.setdefault(cell, set()).add(obj)
+
+    def clear(self):
+        for obj in tuple(self.where):
+            self.refs[obj] = 1
+            self.remove(obj)
+
+    def within(self, xmin, ymin, xmax, ymax):
+        "Objects whose position lies in the box."
+        cs = self.cell_size
+        (imin, imax) = (floor(xmin/cs), floor(xmax/cs))
+        (jmin, jmax) = (floor(ymin/cs), floor(ymax/cs))
+        result = []
+        if (imax-imin+1) * (jmax-jmin+1) > len(self.cells):
+            cells = [cell for cell in self.cells
+                     if imin <= cell[0] <= imax and jmin <= cell[1] <= jmax]
+        else:
+            cells = [(i,j) for i in range(imin,imax+1) for j in range(jmin,jmax+1)
+                     if (i,j) in self.cells]
+        for cell in cells:
+            for obj in self.cells[cell]:
+                if xmin <= obj.x <= xmax and ymin <= obj.y <= ymax:
+                    result.append(obj)
+        return result
+
+    def near(self, x, y, radius):
+        "Objects within radius of (x,y)."
+        rsq = radius * radius
+        return [obj for obj in self.within(x-radius, y-radius, x+radius, y+radius)
+                if (obj.x-x)**2 + (obj.y-y)**2 <= rsq]
+
+    def nearest(self, x, y, test=None, max_dist=inf):
+        """Nearest object to (x,y) satisfying test, or None.  Searches
+        rings of cells outward until no unvisited cell can hold a
+        closer object."""
+        center = self.cell_of(x, y)
+        if center is None or not self.cells:
+            return None
+        (ci, cj) = center
+        cs = self.cell_size
+        (best, best_distsq) = (None, max_dist*max_dist)
+        remaining = len(self.cells)
+        ring = 0
+        while remaining > 0:
+            reach = (ring-1) * cs
+            if reach > 0 and reach*reach > best_distsq:
+                break
+            if ring == 0:
+                ring_cells = [center]
+            else:
+                ring_cells = [(ci+di, cj+ring*side) for di in range(-ring,ring+1) for side in (-1,1)] + \
+                             [(ci+ring*side, cj+dj) for dj in range(-ring+1,ring) for side in (-1,1)]
+            for cell in ring_cells:
+                members = self.cells.get(cell, None)
+                if members is None:
+                    continue
+                remaining -= 1
+                for obj in members:
+                    distsq = (obj.x-x)**2 + (obj.y-y)**2
+                    if distsq <= best_distsq and (test is None or test(obj)):
+                        (best, best_distsq) = (obj, distsq)
+            ring += 1
+        return best
+
+
+class WorldObjects(dict):
+    """The dictionary of world map objects, with secondary indexes kept
+    up to date as entries come and go: by type of object, by name (for
+    keys that have one, such as SDK faces), and by position."""
+    def __init__(self, *args, **kwargs):
+        super().__init__()
+        self.types = dict()     # class -> {key: object}
+        self.names = dict()     # name -> set of keys
+        self.grid = SpatialGrid()
+        self.update(*args, **kwargs)
+
+    def __reduce__(self):
+        # Pickle and copy as a plain dict; the indexes are rebuilt.
+        return (WorldObjects, (dict(self),))
+
+    def index(self, key, value):
+        self.types.setdefault(type(value), dict())[key] = value
+        name = getattr(key, 'name', None)
+        if isinstance(name, str):
+            self.names.setdefault(name, set()).add(key)
+        if hasattr(value,'x') and hasattr(value,'y'):
+            self.grid.add(value)
+
+    def unindex(self, key, value):
+        entries = self.types[type(value)]
+        del entries[key]
+        if not entries:
+            del self.types[type(value)]
+        for (name, keys) in tuple(self.names.items()):
+            if key in keys:
+                keys.discard(key)
+                if not keys:
+                    del self.names[name]
+                break
+        if value in self.grid.refs:
+            self.grid.remove(value)
+
+    def __setitem__(self, key, value):
+        if key in self:
+            self.unindex(key, self[key])
+        super().__setitem__(key, value)
+        self.index(key, value)
+
+    def __delitem__(self, key):
+        value = self[key]
+        super().__delitem__(key)
+        self.unindex(key, value)
+
+    def pop(self, key, *default):
+        if key not in self:
+            return super().pop(key, *default)
+        value = super().pop(key)
+        self.unindex(key, value)
+        return value
+
+    def popitem(self):
+        (key, value) = super().popitem()
+        self.unindex(key, value)
+        return (key, value)
+
+    def setdefault(self, key, default=None):
+        if key not in self:
+            self[key] = default
+        return self[key]
+
+    def update(self, *args, **kwargs):
+        for (key, value) in dict(*args, **kwargs).items():
+            self[key] = value
+
+    def clear(self):
+        super().clear()
+        self.types.clear()
+        self.names.clear()
+        self.grid.clear()
+
+    def items_of_type(self, *classes):
+        "(key, object) pairs for objects that are instances of classes."
+        return [item for (cls, entries) in self.types.items() if issubclass(cls, classes)
+                for item in entries.items()]
+
+    def of_type(self, *classes):
+        return [value for (cls, entries) in self.types.items() if issubclass(cls, classes)
+                for value in entries.values()]
+
+    def named(self, name):
+        """(key, object) pairs whose key has this name.  Names can change
+        after a key is added (e.g., when a face is recognized), so on a
+        miss stale entries are refiled."""
+        keys = self.names.get(name, ())
+        result = [(key, self[key]) for key in keys if key.name == name]
+        if not result:
+            for (old_name, keys) in tuple(self.names.items()):
+                for key in tuple(keys):
+                    if key.name != old_name:
+                        keys.discard(key)
+                        self.names.setdefault(key.name, set()).add(key)
+                        if key.name == name:
+                            result.append((key, self[key]))
+                if not keys:
+                    del self.names[old_name]
+        return result
+
+    def within(self, xmin, ymin, xmax, ymax, *classes):
+        "Objects positioned in the box, optionally only of the given classes."
+        found = self.grid.within(xmin, ymin, xmax, ymax)
+        return [obj for obj in found if isinstance(obj, classes)] if classes else found
+
+    def near(self, x, y, radius, *classes):
+        found = self.grid.near(x, y, radius)
+        return [obj for obj in found if isinstance(obj, classes)] if classes else found
+
+    def nearest(self, x, y, *classes, max_dist=inf):
+        test = (lambda obj: isinstance(obj, classes)) if classes else None
+        return self.grid.nearest(x, y, test, max_dist)
+
+
 class WorldMap():
     vision_z_fudge = 10  # Cozmo underestimates object z coord by about this much
 
     def __init__(self,robot):
         self.robot = robot
-        self.objects = dict()
+        self.objects = WorldObjects()
         self.shared_objects = dict()
+        self.versions = dict()  # object key -> count of input changes
+        self.stamps = dict()    # object key -> inputs at its last update
         
     def add_fixed_landmark(self,landmark):
         landmark.is_fixed = True
@@ -357,21 +611,68 @@ class WorldMap():
         """Called to update the map after every camera image, after
         object_observed and object_moved events, and just before the
         path planner runs.
+
+        Cubes and the charger are always updated since their map
+        coordinates follow the robot's pose.  Everything else is only
+        touched when its inputs have changed since the last call: a new
+        face or marker sighting, or a new particle filter estimate.
         """
         for (id,cube) in self.robot.world.light_cubes.items():
             self.update_cube(cube)
         if self.robot.world.charger: self.update_charger()
         for face in self.robot.world._faces.values():
-            if face.face_id == face.updated_face_id:                
-                self.update_face(face)
+            if face.face_id == face.updated_face_id:
+                # The SDK reports faces with EvtFaceObserved, not
+                # EvtObjectObserved, so nothing bumps them; compare the
+                # sighting itself instead.
+                position = face.pose and face.pose.position.x_y_z
+                if self.changed(face, position, face.is_visible, face.expression,
+                                face.last_observed_time, self.objects.get(face,None)):
+                    self.update_face(face)
             else:
                 if face in self.robot.world.world_map.objects:
                     del  self.robot.world.world_map.objects[face]
-        self.update_arucos()
-        self.update_walls()
+                    self.forget(face)
+        updated_markers = self.update_arucos()
+        self.update_walls(updated_markers)
         self.update_doorways()
         self.update_perched_cameras()
 
+#================ Change Tracking ================
+
+    def bump(self, key):
+        "Record a change to an input of object key, such as a new sighting."
+        self.versions[key] = self.versions.get(key,0) + 1
+
+    def changed(self, key, *inputs):
+        """True if the version or inputs of object key differ from those
+        seen by the last call, which are then replaced.  Inputs are
+        compared with ==, so objects without __eq__ compare by identity."""
+        stamp = (self.versions.get(key,0),) + inputs
+        if self.stamps.get(key,None) == stamp:
+            return False
+        self.stamps[key] = stamp
+        return True
+
+    def forget(self, key):
+        self.versions.pop(key, None)
+        self.stamps.pop(key, None)
+
+    @staticmethod
+    def landmark_version(landmarks, key):
+        """Something that changes whenever the estimate of landmark key
+        does.  SLAM landmark maps keep version counters; for a plain
+        dict of landmarks we use the estimate itself, which may be an
+        (mu, orient, ...) tuple or an SDK Pose, as in PF_Aruco."""
+        version = getattr(landmarks, 'version', None)
+        if version is not None:
+            return version(key)
+        value = landmarks[key]
+        if isinstance(value, Pose):
+            return (value.position.x, value.position.y, value.position.z,
+                    value.rotation.angle_z.radians)
+        return tuple(np.ravel(value[0]).tolist()) + tuple(np.ravel(value[1]).tolist())
+
     def update_cube(self, cube):
         if cube in self.objects:
             foreign_id = "LightCubeForeignObj-"+str(cube.cube_id)
@@ -428,20 +729,37 @@ class WorldMap():
         return wmobject
 
     def update_arucos(self):
+        """Update the markers in the current image, unless neither the
+        marker's pose relative to the camera, the head angle, nor the
+        particle filter's estimate has changed since the last call.
+        Returns the ids of the markers updated."""
+        updated = set()
         try:
             seen_marker_objects = self.robot.world.aruco.seen_marker_objects
         except:
-            return
+            return updated
         aruco_parent = self.robot.world.aruco
+        landmarks = self.robot.world.particle_filter.sensor_model.landmarks
         for (id,value) in seen_marker_objects.items():
             wmobject = self.objects.get(id, None)
+            lm_version = self.landmark_version(landmarks,id) if id in landmarks else None
+            sighting = tuple(float(c) for c in value.camera_coords)
+            if not self.changed(id, sighting, self.robot.head_angle.radians,
+                                wmobject, lm_version):
+                continue
+            updated.add(id)
             if wmobject is None:
                 wmobject = ArucoMarkerObj(aruco_parent,id)
                 self.objects[id] = wmobject
                 pftuple = None
             else:
-                pftuple = self.robot.world.particle_filter.sensor_model.landmarks.get(id, None)
-            if pftuple:  # Particle filter is tracking this marker
+                pftuple = landmarks.get(id, None)
+            if isinstance(pftuple, Pose):  # fixed landmark given as an SDK Pose
+                wmobject.x = pftuple.position.x
+                wmobject.y = pftuple.position.y
+                wmobject.theta = pftuple.rotation.angle_z.radians
+                wmobject.z = pftuple.position.z
+            elif pftuple:  # Particle filter is tracking this marker
                 wmobject.x = pftuple[0][0][0]
                 wmobject.y = pftuple[0][1][0]
                 wmobject.theta = pftuple[1]
@@ -457,10 +775,22 @@ class WorldMap():
             else:
                 # convert aruco sensor values to pf coordinates and update
                 pass
-                
-    def update_walls(self):
-        for key, value in self.robot.world.particle_filter.sensor_model.landmarks.items():
+        return updated
+
+    def update_walls(self, updated_markers=()):
+        """Update walls whose particle filter estimate has changed, and
+        put their markers back in place if the wall or any of its
+        markers was updated."""
+        landmarks = self.robot.world.particle_filter.sensor_model.landmarks
+        for key in landmarks:
             if isinstance(key,str) and 'Wall-' in key:
+                spec = wall_marker_dict[key[5:]]
+                present = tuple(m in self.objects for m in spec.markers)
+                if not (self.changed(key, self.landmark_version(landmarks,key),
+                                     self.objects.get(key,None), present) or
+                        any(m in updated_markers for m in spec.markers)):
+                    continue
+                value = landmarks[key]
                 if key in self.objects and isinstance(self.objects[key], WallObj):
                     wall = self.objects[key]
                     if (not wall.is_fixed) and (not wall.is_foreign):
@@ -485,7 +815,6 @@ class WorldMap():
                     # Make the doorways
                     wall.make_doorways(self.robot.world.world_map)
                 # Relocate the aruco markers to their predefined positions
-                spec = wall_marker_dict[wall.id[5:]]
                 for key,value in spec.markers.items():
                     if key in self.robot.world.world_map.objects:
                         aruco_marker = self.robot.world.world_map.objects[key]
@@ -499,15 +828,16 @@ class WorldMap():
                         aruco_marker.z = rel_xyz[2][0]
         
     def update_doorways(self):
-        for key,value in self.robot.world.world_map.objects.items():
-            if isinstance(key,str) and  'Doorway' in key:
+        for (key,value) in self.objects.items_of_type(DoorwayObj):
+            wall = value.wall
+            if self.changed(key, wall.x, wall.y, wall.theta, wall.length):
                 value.update()
-                
+
 
     def lookup_face_obj(self,face):
         "Look up face by name, not by Face instance."
-        for (key,value) in self.robot.world.world_map.objects.items():
-            if isinstance(key, Face) and key.name == face.name:
+        for (key,value) in self.objects.named(face.name):
+            if isinstance(key, Face):
                 if key is not face and face.is_visible:
                     # Older Face object with same name: replace it with new one
                     self.robot.world.world_map.objects.pop(key)
@@ -580,20 +910,14 @@ class WorldMap():
 
     def update_perched_cameras(self):
         if self.robot.world.server.started:
-            pool = self.robot.world.server.camera_landmark_pool
-            for key, val in pool.get(self.robot.aruco_id,{}).items():
-                if isinstance(key,str) and 'Video' in key:
-                    if key in self.objects:
-                        self.objects[key].update(x=val[0][0,0], y=val[0][1,0], z=val[1][0],
-                                                 theta=val[1][2], phi=val[1][1])
-                    else:
-                        # last digit of capture id as camera key
-                        self.objects[key] = \
-                            CameraObj(id=int(key[-2]), x=val[0][0,0], y=val[0][1,0],
-                                      z=val[1][0], theta=val[1][2], phi=val[1][1])
+            landmarks = self.robot.world.server.camera_landmark_pool.get(self.robot.aruco_id,{})
         else:
-            for key, val in self.robot.world.particle_filter.sensor_model.landmarks.items():
-                if isinstance(key,str) and 'Video' in key:
+            landmarks = self.robot.world.particle_filter.sensor_model.landmarks
+        for key in landmarks:
+            if isinstance(key,str) and 'Video' in key:
+                if self.changed(key, self.landmark_version(landmarks,key),
+                                self.objects.get(key,None)):
+                    val = landmarks[key]
                     if key in self.objects:
                         self.objects[key].update(x=val[0][0,0], y=val[0][1,0], z=val[1][0],
                                                  theta=val[1][2], phi=val[1][1])
@@ -606,6 +930,7 @@ class WorldMap():
 #================ Event Handlers ================
 
     def handle_object_observed(self, evt, **kwargs):
+        self.bump(evt.obj)
         if isinstance(evt.obj, LightCube):
             self.update_cube(evt.obj)
         elif isinstance(evt.obj, CustomObject):
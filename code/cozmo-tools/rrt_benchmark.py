@@ -0,0 +1,207 @@
+#!/usr/bin/env python3
+
+"""
+RRT Benchmark for cozmo_fsm
+===========================
+
+Runs the RRT path planner headlessly on a set of canned arenas, using a
+stub robot with Cozmo's real kinematics, and reports plan time, nodes
+expanded, collision checks, path length, and success rate.  No robot
+or SDK connection is needed.
+
+Usage:
+    python3 rrt_benchmark.py
+    python3 rrt_benchmark.py --arena doorway --trials 20 --seed 1
+    python3 rrt_benchmark.py --anytime --budget 0.5 --sampler bridge
+
+Every trial uses a planner seeded from --seed, so runs are repeatable
+and two versions of the planner can be compared on identical problems.
+"""
+
+import argparse
+import contextlib
+import io
+import statistics
+import time
+from math import pi, nan
+
+import cozmo
+
+from cozmo_fsm.cozmo_kin import CozmoKinematics
+from cozmo_fsm.rrt import *
+from cozmo_fsm.worldmap import WallObj, WallSpec, CustomCubeObj, ChipObj, WorldObjects
+from cozmo_fsm import wall_defs
+
+#---------------- Stub Robot ----------------
+
+class StubParticleFilter():
+    def pose_estimate(self):
+        return (0., 0., 0.)
+
+class StubWorldMap():
+    def __init__(self, objects):
+        self.objects = WorldObjects(objects)
+
+    def update_map(self):
+        pass
+
+class StubWorld():
+    def __init__(self, objects):
+        self.world_map = StubWorldMap(objects)
+        self.particle_filter = StubParticleFilter()
+
+class StubRobot():
+    "Just enough of a robot for CozmoKinematics and RRT.generate_obstacles."
+    def __init__(self, objects):
+        self.head_angle = cozmo.util.degrees(0)
+        self.lift_height = cozmo.util.distance_mm(32)
+        self.carrying = None
+        self.world = StubWorld(objects)
+        CozmoKinematics(self)   # sets self.kine
+
+#---------------- Arenas ----------------
+
+class Arena():
+    def __init__(self, name, queries):
+        self.name = name
+        self.objects = dict()
+        self.queries = queries   # list of (start, goal) RRTNodes
+
+    def add(self, obj):
+        obj.pose_confidence = +1
+        self.objects[obj.id] = obj
+        return obj
+
+    def wall(self, label, x, y, theta, length=None, spec=None):
+        if spec is None:
+            spec = WallSpec(label=label, length=length)
+        return self.add(WallObj(id='Wall-'+label, x=x, y=y, theta=theta, wall_spec=spec))
+
+    def room(self, width, height):
+        self.wall('bench-N', 0, height/2, pi/2, width)
+        self.wall('bench-S', 0, -height/2, pi/2, width)
+        self.wall('bench-E', width/2, 0, 0, height)
+        self.wall('bench-W', -width/2, 0, 0, height)
+
+def grid_positions(n, spacing, x0, y0, columns):
+    return [(x0 + (i % columns) * spacing, y0 + (i // columns) * spacing) for i in range(n)]
+
+def make_arenas():
+    arenas = []
+
+    # A room split by wall 1 from wall_defs, whose 77 mm doorways are
+    # barely wider than the robot.
+    doorway = Arena('doorway', [(RRTNode(x=-350, y=0, q=0), RRTNode(x=350, y=0, q=0)),
+                                (RRTNode(x=-350, y=200, q=pi/2), RRTNode(x=350, y=-200, q=nan))])
+    doorway.room(1000, 800)
+    spec = wall_defs.wall_marker_dict[1]
+    doorway.wall(spec.id[5:], 0, 0, 0, spec=spec)
+    doorway.wall('bench-gap1', 0, 350, 0, 100)
+    doorway.wall('bench-gap2', 0, -350, 0, 100)
+    arenas.append(doorway)
+
+    # Cube clutter in an open room.
+    clutter = Arena('clutter', [(RRTNode(x=-500, y=-500, q=0), RRTNode(x=500, y=500, q=nan)),
+                                (RRTNode(x=-500, y=500, q=-pi/2), RRTNode(x=500, y=-500, q=0))])
+    clutter.room(1300, 1300)
+    for (i, (x, y)) in enumerate(grid_positions(16, 220, -330, -330, 4)):
+        clutter.add(CustomCubeObj(None, id='Cube-%d' % i, x=x + (i % 3 - 1) * 40,
+                                  y=y + (i % 2) * 60, theta=i * pi/7, size=(50., 50., 50.)))
+    arenas.append(clutter)
+
+    # A field of chips.
+    chips = Arena('chips', [(RRTNode(x=-450, y=0, q=0), RRTNode(x=450, y=0, q=nan)),
+                            (RRTNode(x=0, y=-450, q=pi/2), RRTNode(x=0, y=450, q=pi/2))])
+    chips.room(1100, 1100)
+    for (i, (x, y)) in enumerate(grid_positions(25, 150, -300, -300, 5)):
+        chips.add(ChipObj('Chip-%d' % i, x + (i % 2) * 50, y))
+    arenas.append(chips)
+
+    # Two rooms joined by doorways, with cubes and chips on both sides.
+    mixed = Arena('mixed', [(RRTNode(x=-450, y=-300, q=0), RRTNode(x=450, y=300, q=nan)),
+                            (RRTNode(x=450, y=-300, q=pi), RRTNode(x=-450, y=300, q=pi/2))])
+    mixed.room(1200, 900)
+    spec = wall_defs.wall_marker_dict[13]
+    mixed.wall(spec.id[5:], 0, -150, 0, spec=spec)
+    mixed.wall('bench-gap3', 0, 300, 0, 300)
+    for (i, (x, y)) in enumerate([(-300, 0), (-250, 250), (300, -100), (250, 150)]):
+        mixed.add(CustomCubeObj(None, id='Cube-%d' % i, x=x, y=y, theta=i * pi/5,
+                                size=(50., 50., 50.)))
+    for (i, (x, y)) in enumerate([(-150, -250), (-400, 100), (150, 250), (400, -250)]):
+        mixed.add(ChipObj('Chip-%d' % i, x, y))
+    arenas.append(mixed)
+
+    return arenas
+
+#---------------- Benchmark ----------------
+
+samplers = {
+    'uniform' : lambda: UniformSampler(),
+    'goal' : lambda: GoalBiasedSampler(),
+    'gaussian' : lambda: GoalBiasedSampler(base=GaussianSampler()),
+    'bridge' : lambda: GoalBiasedSampler(base=BridgeSampler()),
+    'free' : lambda: GoalBiasedSampler(base=FreeSpaceSampler()),
+    }
+
+def run_arena(arena, trials, seed, planner_args):
+    robot = StubRobot(arena.objects)
+    results = []
+    for trial in range(trials):
+        for (start, goal) in arena.queries:
+            rrt = RRT(robot, seed=seed+trial, use_plan_cache=False, **planner_args)
+            try:
+                # generate_obstacles prints every wall it converts
+                with contextlib.redirect_stdout(io.StringIO()):
+                    rrt.plan_path(start.copy(), goal.copy())
+                success = True
+            except RRTException:
+                success = False
+            rrt.close()
+            results.append((success, rrt.stats))
+    return results
+
+def mean(values):
+    return statistics.mean(values) if values else nan
+
+def report(arena, results):
+    solved = [stats for (success, stats) in results if success]
+    print('%-8s %6.0f%% %9.3f %9.3f %8.0f %10.0f %9.0f' %
+          (arena.name,
+           100 * len(solved) / len(results),
+           mean([stats['time'] for (_, stats) in results]),
+           statistics.median([stats['time'] for (_, stats) in results]),
+           mean([stats['nodes'] for (_, stats) in results]),
+           mean([stats['collision_checks'] for (_, stats) in results]),
+           mean([stats['path_length'] for stats in solved])))
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the cozmo_fsm RRT planner.')
+    parser.add_argument('--arena', action='append',
+                        help='arena to run (repeatable; default all)')
+    parser.add_argument('--trials', type=int, default=10)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--max-iter', type=int, default=2000)
+    parser.add_argument('--sampler', choices=sorted(samplers), default='uniform')
+    parser.add_argument('--anytime', action='store_true', help='use the anytime RRT* mode')
+    parser.add_argument('--budget', type=float, default=1.0, help='anytime time budget (s)')
+    parser.add_argument('--cspace', action='store_true', help='use the C-space grid')
+    parser.add_argument('--parallel', type=int, default=0, help='number of parallel planners')
+    args = parser.parse_args()
+
+    arenas = make_arenas()
+    if args.arena:
+        arenas = [arena for arena in arenas if arena.name in args.arena]
+    planner_args = dict(max_iter=args.max_iter, anytime=args.anytime,
+                        time_budget=args.budget, use_cspace_grid=args.cspace,
+                        parallel=args.parallel)
+
+    print('%-8s %7s %9s %9s %8s %10s %9s' %
+          ('arena', 'success', 'mean s', 'median s', 'nodes', 'checks', 'length'))
+    start_time = time.time()
+    for arena in arenas:
+        planner_args['sampler'] = samplers[args.sampler]()
+        report(arena, run_arena(arena, args.trials, args.seed, planner_args))
+    print('Total %.1f seconds.' % (time.time() - start_time))
+
+if __name__ == '__main__':
+    main()
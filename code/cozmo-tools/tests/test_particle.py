@@ -0,0 +1,33 @@
+from types import SimpleNamespace
+
+import numpy as np
+from cozmo.util import Pose, degrees
+
+from cozmo_fsm.particle import ParticleStore, SLAMSensorModel
+from cozmo_fsm.worldmap import WallObj, WallSpec
+
+def wall_setup(is_moving):
+    """A fixed wall at x=400 with marker 190 mounted on it, a robot at
+    the origin looking straight at the marker, and particles spread out
+    around the robot."""
+    spec = WallSpec(length=300, markers={190: (1, (150, 50))})
+    wall = WallObj(x=400, y=0, theta=0, wall_spec=spec, is_fixed=True)
+    robot = SimpleNamespace(pose=Pose(0, 0, 0, angle_z=degrees(0)), is_moving=is_moving)
+    sensor_model = SLAMSensorModel(robot)
+    sensor_model.add_wall_field(wall)
+    particles = ParticleStore(20)
+    particles.x = np.random.RandomState(0).normal(0, 50, 20)
+    particles.y = np.random.RandomState(1).normal(0, 50, 20)
+    marker = SimpleNamespace(camera_distance=400., camera_coords=(0., 0., 400.))
+    return (sensor_model, particles, {190: marker})
+
+def test_wall_fields_score_when_still():
+    (sensor_model, particles, seen) = wall_setup(is_moving=False)
+    sensor_model.evaluate_wall_fields(particles, seen, [190], False)
+    assert (particles.log_weight < 0).any()
+
+def test_wall_fields_ignored_while_moving():
+    # Marker sightings are blurred in motion, as for inferred walls.
+    (sensor_model, particles, seen) = wall_setup(is_moving=True)
+    sensor_model.evaluate_wall_fields(particles, seen, [190], False)
+    assert (particles.log_weight == 0).all()
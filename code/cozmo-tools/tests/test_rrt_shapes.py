@@ -0,0 +1,40 @@
+from math import pi
+
+import numpy as np
+
+from cozmo_fsm import transform
+from cozmo_fsm.rrt_shapes import Rectangle, Circle, collides_translated, collides_batch
+
+def corner_case():
+    """A 20x20 square at the origin and a circle of radius 5 just off its
+    (10,10) corner.  The circle's bounding square overlaps the square,
+    but the circle itself is 5.66 from the corner, so they don't touch."""
+    rect = Rectangle(center=transform.point(0,0), dimensions=(20,20))
+    circle = Circle(center=transform.point(14,14), radius=5)
+    return (rect, circle)
+
+def test_circle_off_corner_is_clear():
+    (rect, circle) = corner_case()
+    assert not rect.collides(circle)
+    assert not circle.collides(rect)
+
+def test_circle_over_corner_collides():
+    (rect, _) = corner_case()
+    assert rect.collides(Circle(center=transform.point(13,13), radius=5))
+
+def test_circle_off_rotated_corner_is_clear():
+    rect = Rectangle(center=transform.point(0,0), dimensions=(20,20), orient=pi/4)
+    # The rotated square's corner is at (0, 14.14), so its diagonal
+    # points straight up the y axis.
+    circle = Circle(center=transform.point(0, 10*np.sqrt(2) + 5.5), radius=5)
+    assert not rect.collides(circle)
+
+def test_vectorized_tests_agree_at_corner():
+    (rect, circle) = corner_case()
+    dx = np.array([0., -1., 1.])
+    dy = np.array([0., -1., 1.])
+    # Shifting the square by (1,1) brings its corner within reach.
+    expected = [False, False, True]
+    assert collides_translated(rect, circle, dx, dy).tolist() == expected
+    assert collides_translated(circle, rect, -dx, -dy).tolist() == expected
+    assert collides_batch([rect], [circle], dx, dy) == 2
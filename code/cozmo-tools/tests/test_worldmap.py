@@ -0,0 +1,55 @@
+from types import SimpleNamespace
+
+from cozmo.faces import Face
+from cozmo.util import Pose, degrees
+
+from cozmo_fsm.worldmap import WorldMap, FaceObj
+
+class FakeFace(Face):
+    "Just the parts of an SDK Face that the world map reads."
+    # Plain class attributes shadow the SDK's read-only properties.
+    face_id = updated_face_id = 1
+    name = 'Alice'
+    pose = None
+    is_visible = True
+    expression = 'happy'
+    last_observed_time = 0
+
+    def __init__(self):
+        pass
+
+    def see(self, x, y, z, time):
+        self.pose = Pose(x, y, z, angle_z=degrees(0))
+        self.last_observed_time = time
+
+def make_world_map(face):
+    robot = SimpleNamespace(
+        pose = Pose(0, 0, 0, angle_z=degrees(0)),
+        world = SimpleNamespace(light_cubes={}, charger=None, _faces={1: face},
+                                aruco=SimpleNamespace(seen_marker_objects={}),
+                                particle_filter=SimpleNamespace(pose=(0, 0, 0),
+                                                                sensor_model=SimpleNamespace(landmarks={})),
+                                server=SimpleNamespace(started=False)))
+    world_map = WorldMap(robot)
+    robot.world.world_map = world_map
+    return world_map
+
+def test_face_follows_new_sightings():
+    # The SDK reports faces with EvtFaceObserved, which doesn't reach
+    # handle_object_observed, so update_map must notice the new pose.
+    face = FakeFace()
+    world_map = make_world_map(face)
+    face.see(300, 0, 100, time=1)
+    world_map.update_map()
+    face_obj = world_map.objects[face]
+    assert isinstance(face_obj, FaceObj)
+    assert (face_obj.x, face_obj.y) == (300, 0)
+    face.see(250, 80, 120, time=2)
+    face.expression = 'surprised'
+    world_map.update_map()
+    assert world_map.objects[face] is face_obj
+    assert (face_obj.x, face_obj.y, face_obj.z) == (250, 80, 120)
+    assert face_obj.expression == 'surprised'
+    face.see(200, -50, 110, time=3)
+    world_map.update_map()
+    assert (face_obj.x, face_obj.y, face_obj.z) == (200, -50, 110)